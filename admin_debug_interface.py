@@ -11,17 +11,25 @@ import time
 logger = logging.getLogger(__name__)
 
 class AdminDebugInterface(object):
-    def __init__(self, service_status, clients, active_clients, address_client_list, ring_queue):
+    def __init__(self, service_status, clients, sessions, rings, cipher_cache, outbound_metrics, load_stats,
+                 connection_stats=dict):
         self.service_status = service_status  # [{'name': service, 'status': status}, ...]
         self.clients = clients  # [uuid1, uuid2, ...]
-        self.active_clients = active_clients
-        self.address_client_list = address_client_list  # [{'service': 'asdf', 'address': 'asdf@asdf.net', 'UUID': 'uuid'}, ...]
-        self.ring_queue = ring_queue  # [{'ID':-, 'address':-, 'text':-,'service':-, 'timeout_handle':-}, ...]
+        self.sessions = sessions  # SessionRegistry of active clients and address associations
+        self.rings = rings  # RingTable of rings waiting for a client
+        self.cipher_cache = cipher_cache  # CipherCache of this process
+        self.outbound_metrics = outbound_metrics  # {service: {lane: {'depth':-, 'sent':-, ...}, ...}, ...}
+        self.load_stats = load_stats  # Callable returning {'messages_rejected':-, 'high_water':-, 'inbound_depths':-}
+        # Callable returning {'inter_com': {connection name: {'up':-, 'sent':-, 'dropped':-, 'state':-}, ...}[,
+        #                     'connector_processes': {name: {'alive':-, 'restarts':-}, ...}]}
+        self.connection_stats = connection_stats
 
     def request(self, msg):
         if msg == 'help':
             return "NL chat debug data. request commands: 'service_status'," \
-                   " 'clients', 'active_clients', 'address_assoc' or 'ring_queue'. form types: 'text' or 'json_data'"
+                   " 'clients', 'active_clients', 'address_assoc', 'ring_queue', 'cipher_cache', 'outbound'," \
+                   " 'load' or 'connections'." \
+                   " form types: 'text' or 'json_data'"
         try:
             request, return_data_form = msg.split(' ')
         except ValueError:
@@ -37,6 +45,14 @@ class AdminDebugInterface(object):
             return self.address_client_list_to_form(return_data_form)
         elif request == 'ring_queue':
             return self.ring_queue_to_form(return_data_form)
+        elif request == 'cipher_cache':
+            return self.cipher_cache_to_form(return_data_form)
+        elif request == 'outbound':
+            return self.outbound_metrics_to_form(return_data_form)
+        elif request == 'load':
+            return self.load_stats_to_form(return_data_form)
+        elif request == 'connections':
+            return self.connection_stats_to_form(return_data_form)
 
     def service_status_to_form(self, form):
         if form == 'text':
@@ -59,20 +75,20 @@ class AdminDebugInterface(object):
     def active_clients_to_form(self, form):
         if form == 'text':
             string = 'Active clients:\n'
-            for client in self.active_clients['list']:
+            for client in self.sessions.active_list():
                 string += client+'\n'
             return string+'\n'
         elif form == 'json_data':
-            return json.dumps(self.active_clients['list'])
+            return json.dumps(self.sessions.active_list())
 
     def address_client_list_to_form(self, form):
         if form == 'text':
             string = 'Address client associations:\n'
-            for client_ass in self.address_client_list:
-                string += 'UUID:'+client_ass['UUID']+'. Service:'+client_ass['service']+'.\tAddress:'+self.hash_str(client_ass['address'])+'.\n'
+            for client_ass in self.sessions.associations():
+                string += 'UUID:'+client_ass.UUID+'. ID:'+str(client_ass.ID)+'. Service:'+client_ass.service+'.\tAddress:'+self.hash_str(client_ass.address)+'.\n'
             return string+'\n'
         elif form == 'json_data':
-            address_client_list = self.address_client_list
+            address_client_list = [association.to_dict() for association in self.sessions.associations()]
             for x in range(0, len(address_client_list)):
                 address_client_list[x]['address'] = self.hash_str(address_client_list[x]['address'])
             return json.dumps(address_client_list)
@@ -80,31 +96,112 @@ class AdminDebugInterface(object):
     def ring_queue_to_form(self, form):
         if form == 'text':
             string = 'Ring queue:\n'
-            for item in self.ring_queue['list']:
-                string += 'ID:'+str(item['ID'])+'. Service:'+item['service']+'.\tAddress:'+self.hash_str(item['address'])+'.\n'
+            for ring in self.rings.rings():
+                string += 'ID:'+str(ring.ID)+'. Service:'+ring.service+'. Wave:'+str(ring.wave)+'.\tAddress:'+self.hash_str(ring.address)+'.\n'
             return string+'\n'
         elif form == 'json_data':
-            ring_queue = self.ring_queue['list']
-            for x in range(0, len(ring_queue)):
-                ring_queue[x]['address'] = self.hash_str(ring_queue[x]['address'])
-                ring_queue[x].pop('text')
-                ring_queue[x]['timeout_handle'] = hex(hash(ring_queue[x]['timeout_handle']))
+            ring_queue = []
+            for ring in self.rings.rings():  # Copies, the live rings are left as they are
+                item = ring.to_dict()
+                item['address'] = self.hash_str(item['address'])
+                item.pop('text')
+                ring_queue.append(item)
             return json.dumps(ring_queue)
 
+    def cipher_cache_to_form(self, form):
+        stats = self.cipher_cache.stats()
+        if form == 'text':
+            string = 'Cipher cache (dispatch process):\n'
+            for name in ('size', 'max_size', 'hits', 'misses', 'evictions'):
+                string += name+': '+str(stats[name])+'\n'
+            return string
+        elif form == 'json_data':
+            return json.dumps(stats)
+
+    def outbound_metrics_to_form(self, form):
+        if form == 'text':
+            string = 'Outbound lanes:\n'
+            for service, lanes in self.outbound_metrics.items():
+                for lane, stats in lanes.items():
+                    string += '%s %s: depth %d, sent %d, superseded %d, avg wait %.2fs, max wait %.2fs\n' % (
+                        service, lane, stats['depth'], stats['sent'], stats['superseded'], stats['avg_wait'],
+                        stats['max_wait'])
+            return string
+        elif form == 'json_data':
+            return json.dumps(self.outbound_metrics)
+
+    def load_stats_to_form(self, form):
+        stats = self.load_stats()
+        if form == 'text':
+            string = 'Messages rejected: '+str(stats['messages_rejected'])+'\n'
+            string += 'Inbound queue depths (high water '+str(stats['high_water'])+'):\n'
+            for name, depth in stats['inbound_depths'].items():
+                string += name+': '+str(depth)+'\n'
+            string += 'Client conversations:\n'
+            for uuid, load in stats.get('client_load', {}).items():
+                string += uuid+': '+str(load['load'])+'/'+str(load['capacity'])+'\n'
+            waiting = stats.get('waiting_room')
+            if waiting is not None:
+                string += 'Waiting room: %d/%d, longest wait %ds, admitted %d, turned away %d\n' % (
+                    waiting['depth'], waiting['max_size'], waiting['longest_wait'], waiting['admitted'],
+                    waiting['turned_away'])
+                string += 'Waits: '+', '.join(bucket+' '+str(count)
+                                               for bucket, count in waiting['wait_histogram'].items())+'\n'
+            return string
+        elif form == 'json_data':
+            return json.dumps(stats)
+
+    def connection_stats_to_form(self, form):
+        stats = self.connection_stats()
+        if form == 'text':
+            string = 'inter_com connections:\n'
+            for name, health in stats.get('inter_com', {}).items():
+                string += '%s: %s, %s, sent %d, dropped %d\n' % (name, 'up' if health['up'] else 'down',
+                                                                 health['state'], health['sent'], health['dropped'])
+            if 'connector_processes' in stats:
+                string += 'Connector processes:\n'
+                for name, child in stats['connector_processes'].items():
+                    string += '%s: %s, restarts %d\n' % (name, 'alive' if child['alive'] else 'down',
+                                                         child['restarts'])
+            return string
+        elif form == 'json_data':
+            return json.dumps(stats)
+
     def hash_str(self, arg):
         # Change the salt each hour
         salt = str(hash(str(time.gmtime()[3])))
         return hex(hash(str(arg)+salt))
 
 if __name__ == '__main__':
-    from threading import Thread
+    from session_registry import SessionRegistry
     service_status = [{'name': 'Facebook', 'status': 'middle'}]
-    clients = {'list': ['uuid1', 'uuid2']}
-    address_client_list = [{'service': 'asdf', 'address': 'asdf@asdf.net', 'UUID': 'uuid'}]
-    ring_queue =[{'ID': 0, 'address': 'asdf@asdf.net', 'text': 'hi','service': 'Facebook', 'timeout_handle': Thread}]
-    x = AdminDebugInterface(service_status, clients, address_client_list, ring_queue)
+    clients = {'dict': {'uuid1': {}, 'uuid2': {}}}
+    sessions = SessionRegistry()
+    sessions.add_active('uuid')
+    sessions.associate('uuid', 'asdf@asdf.net', 'asdf', 0)
+    from ring_table import Ring, RingTable
+    rings = RingTable()
+    rings.add(Ring(0, 'asdf@asdf.net', 'Facebook', 'Facebook', time.time()+55, ['hi']))
+    class FakeCache(object):
+        def stats(self):
+            return {'size': 1, 'max_size': 1024, 'hits': 3, 'misses': 1, 'evictions': 0}
+    outbound_metrics = {'Facebook': {'message': {'depth': 0, 'sent': 4, 'superseded': 0, 'avg_wait': 0.1,
+                                                 'max_wait': 0.3}}}
+    from waiting_room import WaitingRoom
+    waiting_room = WaitingRoom()
+    waiting_room.join('qwer@qwer.net', 'Facebook', 'hello')
+    load_stats = lambda: {'messages_rejected': 2, 'high_water': 5000, 'inbound_depths': {'Facebook': 12},
+                          'client_load': sessions.load_stats(), 'waiting_room': waiting_room.stats()}
+    connection_stats = lambda: {'inter_com': {'inter_com/0': {'up': True, 'sent': 40, 'dropped': 0,
+                                                              'state': 'session_start'},
+                                              'inter_com/1': {'up': False, 'sent': 2, 'dropped': 7,
+                                                              'state': 'disconnected'}},
+                                'connector_processes': {'Facebook': {'alive': True, 'restarts': 3}}}
+    x = AdminDebugInterface(service_status, clients, sessions, rings, FakeCache(), outbound_metrics, load_stats,
+                            connection_stats)
     print(x.request('help'))
-    for command in ('ring_queue', 'address_assoc', 'active_clients', 'service_status'):
+    for command in ('ring_queue', 'address_assoc', 'active_clients', 'service_status', 'cipher_cache', 'outbound', 'load',
+                    'connections'):
         for form in ('text', 'json_data'):
             print('Requesting %s %s'% (command, form))
             print(x.request(command+' '+form))
\ No newline at end of file
@@ -0,0 +1,61 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+
+class ChatStateStage(object):
+    """Debounces user chat states per address before they are sent on to a client.
+
+    A new state waits at least debounce seconds, and an address sends at most one state per min_interval.
+    A newer state replaces one still waiting, and a state equal to the last one sent is dropped, so
+    composing/paused toggles collapse into whatever the user settled on.
+    """
+    def __init__(self, debounce=0.3, min_interval=1.0):
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.pending = {}  # {str(address): {'address':-, 'state':-, 'due':-}, ...}
+        self.last_sent = {}  # {str(address): {'state':-, 'time':-}, ...}
+        self.dropped = 0
+
+    def push(self, address, state, now=None):
+        now = time.monotonic() if now is None else now
+        key = str(address)
+        last = self.last_sent.get(key)
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.dropped += 1  # Superseded before it was sent
+            if last is not None and last['state'] == state:
+                self.pending.pop(key)  # Toggled back to what the client already shows
+            else:
+                pending['state'] = state
+            return
+        if last is not None and last['state'] == state:
+            self.dropped += 1
+            return
+        due = now + self.debounce
+        if last is not None:
+            due = max(due, last['time'] + self.min_interval)
+        self.pending[key] = {'address': address, 'state': state, 'due': due}
+
+    def pop_due(self, now=None):
+        """Returns [(address, state), ...] ready to send and the seconds until the next one, or None"""
+        now = time.monotonic() if now is None else now
+        ready, next_due = [], None
+        for key, pending in list(self.pending.items()):
+            if pending['due'] <= now:
+                self.pending.pop(key)
+                self.last_sent[key] = {'state': pending['state'], 'time': now}
+                ready.append((pending['address'], pending['state']))
+            elif next_due is None or pending['due'] - now < next_due:
+                next_due = pending['due'] - now
+        return ready, next_due
+
+    def forget(self, address):
+        key = str(address)
+        self.pending.pop(key, None)
+        self.last_sent.pop(key, None)
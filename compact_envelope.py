@@ -0,0 +1,112 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Compact inter_com envelope, negotiated per client with COMPACT_MODE at the 'key' handshake.
+# Only used for AES-GCM session and group messages, the payload is zlib compressed when that helps.
+#
+# XMPP body: '~' + base64 of
+#   version   1 byte   COMPACT_VERSION
+#   flags     1 byte   FLAG_*
+#   uuid_len  1 byte
+#   uuid      uuid_len bytes, utf-8
+#   epoch     4 bytes, big endian, only with FLAG_GROUP
+#   nonce     12 bytes
+#   sealed    rest, AES-GCM ciphertext + 16 byte tag
+# Associated data is the same as the json envelopes: 'UUID:to', or 'group:epoch:to'.
+
+import base64
+import struct
+import zlib
+
+COMPACT_MODE = 'bin1'
+COMPACT_VERSION = 1
+BODY_PREFIX = '~'  # Json envelopes always start with '{'
+FLAG_COMPRESSED = 0x01
+FLAG_TO_ALICE = 0x02
+FLAG_GROUP = 0x04
+FLAG_CONTROL = 0x08  # Set by clients on probeACK, ringACK and key so Dispatch can prioritise them unread
+NONCE_SIZE = 12
+COMPRESS_MIN_SIZE = 128  # Smaller payloads rarely shrink enough to be worth it
+_epoch = struct.Struct('>I')
+
+
+class CompactEnvelope(object):
+    """A parsed compact envelope, nonce and sealed are memoryviews into the received bytes"""
+    __slots__ = ('flags', 'UUID', 'epoch', 'nonce', 'sealed')
+
+    def __init__(self, flags, uuid, epoch, nonce, sealed):
+        self.flags = flags
+        self.UUID = uuid
+        self.epoch = epoch
+        self.nonce = nonce
+        self.sealed = sealed
+
+    @property
+    def to(self):
+        return 'alice' if self.flags & FLAG_TO_ALICE else 'bob'
+
+
+def compress(data):
+    """Returns (flags, payload), compressing the payload when it makes it smaller"""
+    if len(data) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return FLAG_COMPRESSED, compressed
+    return 0, data
+
+
+def decompress(flags, data):
+    if flags & FLAG_COMPRESSED:
+        return zlib.decompress(data)
+    return data
+
+
+def pack(flags, uuid, nonce, sealed, epoch=None):
+    uuid = bytes(uuid, encoding='utf')
+    if epoch is not None:
+        flags |= FLAG_GROUP
+    header = bytes((COMPACT_VERSION, flags, len(uuid))) + uuid
+    if epoch is not None:
+        header += _epoch.pack(epoch)
+    return b''.join((header, nonce, sealed))
+
+
+def unpack(data):
+    """Parses packed bytes without copying the payload, raises ValueError if malformed"""
+    view = memoryview(data)
+    if len(view) < 3 or view[0] != COMPACT_VERSION:
+        raise ValueError('Unknown compact envelope version')
+    flags, uuid_end = view[1], 3 + view[2]
+    uuid = bytes(view[3:uuid_end]).decode('utf')
+    epoch = None
+    if flags & FLAG_GROUP:
+        if len(view) < uuid_end + _epoch.size:
+            raise ValueError('Truncated compact envelope')
+        epoch = _epoch.unpack_from(view, uuid_end)[0]
+        uuid_end += _epoch.size
+    nonce_end = uuid_end + NONCE_SIZE
+    if len(view) < nonce_end:
+        raise ValueError('Truncated compact envelope')
+    return CompactEnvelope(flags, uuid, epoch, view[uuid_end:nonce_end], view[nonce_end:])
+
+
+def peek(data):
+    """Returns (flags, uuid) from the header alone, raises ValueError if malformed"""
+    if len(data) < 3 or data[0] != COMPACT_VERSION or len(data) < 3 + data[2]:
+        raise ValueError('Unknown compact envelope version')
+    return data[1], bytes(data[3:3+data[2]]).decode('utf')
+
+
+def encode_body(packed):
+    return BODY_PREFIX + base64.b64encode(packed).decode('ascii')
+
+
+def is_compact_body(body):
+    return body.startswith(BODY_PREFIX)
+
+
+def decode_body(body):
+    return base64.b64decode(body[len(BODY_PREFIX):])
@@ -7,12 +7,14 @@
 
 
 import time
+import queue
 from threading import Thread
-from fb_xmpp import FBXMPP
-from zoho_xmpp import ZohoXMPP
-from inter_com_xmpp import InterComXMPP
+from inter_com_pool import InterComPool
 from dispatch import Dispatch
 from timeout_thread import TimeoutThread
+from service_connector import make_service_connectors
+from connector_process import ConnectorSupervisor
+from overload import InboundGate
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -31,31 +33,50 @@ class CommunicationThreadingManager(object):
         self.outgoing_queue = outgoing_queue
         self.options = options
         self.kill_event = multiprocessing.Event()
-        self.fb_queue_in = multiprocessing.Queue()
-        self.fb_queue_out = multiprocessing.Queue()
-        self.zoho_queue_in = multiprocessing.Queue()
-        self.zoho_queue_out = multiprocessing.Queue()
-        self.inter_com_queue_in = multiprocessing.Queue()
+        # Inbound queues are bounded, connections write to them through an InboundGate that sheds
+        # low value traffic above the high-water mark. Shed messages are counted in messages_rejected.
+        queue_size = int(self.options.get('inbound_queue_size', 10000))
+        high_water = int(self.options.get('inbound_high_water', queue_size // 2))
+        self.messages_rejected = multiprocessing.Value('i', 0)
+        self.inter_com_queue_in = multiprocessing.Queue(queue_size)
         self.inter_com_queue_out = multiprocessing.Queue()
-        self.Intercommunication_handle = InterCommunication(self.kill_event, self.inter_com_queue_in,
-                                                            self.inter_com_queue_out, self.options)
-        self.FB_thread_handle = FBThread(self.kill_event, self.fb_queue_in,
-                                         self.fb_queue_out, self.options)
-        self.zoho_thread_handle = ZohoThread(self.kill_event, self.zoho_queue_in,
-                                             self.zoho_queue_out, self.options)
+        # With 'connector_processes = 1' every XMPP connection runs in a supervised child process.
+        self.connector_processes = int(self.options.get('connector_processes', 0)) > 0
+        self.Intercommunication_handle = InterCommunication(
+            self.kill_event, InboundGate(self.inter_com_queue_in, high_water, self.messages_rejected),
+            self.inter_com_queue_out, self.options, start_connections=not self.connector_processes)
+        # One connector per service account, see service_connector.
+        self.service_queues, self.connector_handles = make_service_connectors(
+            self.kill_event, self.options,
+            lambda incoming_queue: InboundGate(incoming_queue, high_water, self.messages_rejected), queue_size)
         self.dispatch_thread_handle = Dispatch(self.kill_event, self.root, self.options,
-                                               self.incoming_queue, self.outgoing_queue, self.fb_queue_in,
-                                               self.fb_queue_out, self.zoho_queue_in, self.zoho_queue_out,
-                                               self.inter_com_queue_in, self.inter_com_queue_out)
+                                               self.incoming_queue, self.outgoing_queue, self.service_queues,
+                                               self.inter_com_queue_in, self.inter_com_queue_out,
+                                               self.messages_rejected, high_water, self.connection_health)
+        self.connector_supervisor = None
+        if self.connector_processes:
+            connections = list(self.Intercommunication_handle.pool.connections.values()) + self.connector_handles
+            self.connector_supervisor = ConnectorSupervisor(self.kill_event,
+                                                            [connection.spec() for connection in connections])
         self.email_log_timer = EmailLogTimer(self.kill_event, self.options)
         self.start_communication_threads()
 
+    def connection_health(self):
+        """For the admin interface, called from the dispatch thread"""
+        health = {'inter_com': self.Intercommunication_handle.pool.health()}
+        if self.connector_supervisor is not None:
+            health['connector_processes'] = self.connector_supervisor.status()
+        return health
+
     def kill_all(self):
         """Stop all running communication threads"""
         self.kill_event.set()  # Send kill signal to threads
         self.Intercommunication_handle.join()
-        self.FB_thread_handle.join()
-        self.zoho_thread_handle.join()
+        if self.connector_supervisor is not None:
+            self.connector_supervisor.join()
+        else:
+            for connector in self.connector_handles:
+                connector.join()
         self.dispatch_thread_handle.join()
         self.email_log_timer.join()
 
@@ -66,112 +87,47 @@ class CommunicationThreadingManager(object):
         # Staggered starts are used for cx_freeze compatibility with sleekxmpp.
         self.Intercommunication_handle.daemon = True
         self.Intercommunication_handle.start()
-        self.FB_thread_handle.daemon = True
-        TimeoutThread(1, lambda x: x.start(), self.FB_thread_handle).start()
-        self.zoho_thread_handle.daemon = True
-        TimeoutThread(2, lambda x: x.start(), self.zoho_thread_handle).start()
+        if self.connector_supervisor is not None:
+            self.connector_supervisor.daemon = True
+            self.connector_supervisor.start()
+        else:
+            for delay, connector in enumerate(self.connector_handles, 1):
+                connector.daemon = True
+                TimeoutThread(delay, lambda x: x.start(), connector).start()
         self.email_log_timer.daemon = True
         self.email_log_timer.start()
 
 
 class InterCommunication(Thread):
-    def __init__(self, kill_event, incoming_queue, outgoing_queue, options):
+    """Routes Dispatch's (msg, uuid) items to the pooled inter_com connections, see InterComPool"""
+    def __init__(self, kill_event, incoming_queue, outgoing_queue, options, start_connections=True):
         super().__init__()
         self.kill_event = kill_event
         self.incoming_queue = incoming_queue
         self.outgoing_queue = outgoing_queue
-        self.username = options['accounts']['inter_com']['username']
-        self.password = options['accounts']['inter_com']['password']
+        self.pool = InterComPool(kill_event, incoming_queue, options)
+        self.start_connections = start_connections  # False when a ConnectorSupervisor runs them as processes
 
     def run(self):
-        inter_com = InterComXMPP(self.username, self.password, self.incoming_queue)
-        if inter_com.connect():
-            inter_com.process()
-            logger.info('Connected to: %s', 'inter_com')
-        else:
-            logger.info('Unable to connect to: %s', 'inter_com')
+        if self.start_connections:
+            for connection in self.pool.connections.values():
+                connection.start()
+        logger.info('inter_com connections: %s', ', '.join(self.pool.connections))
         while True:  # main thread loop
-            msg_to_process = False
             try:
                 msg, uuid = self.outgoing_queue.get(timeout=0.1)
-                msg_to_process = True
-            except:  # TODO Narrow exception
+                self.pool.send(msg, uuid)
+            except queue.Empty:
                 pass
-            if msg_to_process:
-                inter_com.reply_message(msg, self.username, uuid)
             if self.kill_event.is_set():
-                inter_com.disconnect()
+                if self.start_connections:
+                    for connection in self.pool.connections.values():
+                        connection.join()
                 logger.info('Thread ending: %s', 'inter_com')
                 break
         return
 
 
-class FBThread(Thread):
-    def __init__(self, kill_event, incoming_queue, outgoing_queue, options):
-        super().__init__()
-        self.kill_event = kill_event
-        self.incoming_queue = incoming_queue
-        self.outgoing_queue = outgoing_queue
-        self.options = options
-        
-    def run(self):
-        fb_msger = FBXMPP(self.options['accounts']['facebook']['username'],
-                          self.options['accounts']['facebook']['password'], self.incoming_queue)
-        if fb_msger.connect():
-            fb_msger.process()
-            logger.info('Connected to: %s', 'Facebook')
-        else:
-            logger.info('Unable to connect to: %s', 'Facebook')
-        while True:  # main thread loop
-            msg_to_send = False
-            try:
-                user_id, msg, state = self.outgoing_queue.get(timeout=0.1)
-                msg_to_send = True
-            except:  # TODO Narrow exception
-                pass
-            if msg_to_send:
-                fb_msger.reply_message(user_id, msg, state)
-            if self.kill_event.is_set():
-                fb_msger.disconnect()
-                logger.info('Thread ending: %s', 'Facebook')
-                break
-        return
-
-class ZohoThread(Thread):
-    def __init__(self, kill_event, incoming_queue, outgoing_queue, options):
-        super().__init__()
-        self.kill_event = kill_event
-        self.incoming_queue = incoming_queue
-        self.outgoing_queue = outgoing_queue
-        self.options = options
-        
-    def run(self):
-        username = self.options['accounts']['zoho']['username'].replace('\\\\', '\\')
-        zoho_msger = ZohoXMPP(username,
-                              self.options['accounts']['zoho']['password'],
-                              self.incoming_queue)
-        if zoho_msger.connect(('zchat.zoho.com', 5222)):
-            zoho_msger.process()
-            logger.info('Connected to: %s', 'Zoho')
-        else:
-            logger.info('Unable to connect to: %s', 'Zoho')
-        
-        while True:  # main thread loop
-            msg_to_send = False
-            try:
-                user_id, msg, state = self.outgoing_queue.get(timeout=0.1)
-                msg_to_send = True
-            except:  # TODO Narrow exception
-                pass
-            if msg_to_send:
-                zoho_msger.reply_message(user_id, msg, state)
-            if self.kill_event.is_set():
-                zoho_msger.disconnect()
-                logger.info('Thread ending: %s', 'Zoho')
-                break
-        return
-
-
 class EmailLogTimer(Thread):
     def __init__(self, kill_event, options):
         super().__init__()
@@ -0,0 +1,91 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Process per connector mode, 'connector_processes = 1' in settings.ini. Each XMPP connection (inter_com and
+# service accounts) is rebuilt from its spec() in a child process and run there, so XML parsing no longer
+# shares the GIL with Dispatch. The connectors only talk to the rest of the server through multiprocessing
+# queues, values and the kill_event, which all work across processes.
+
+import multiprocessing
+from threading import Thread
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+def run_connector(name, connector_class, kwargs):
+    """Child process entry point, runs the connector's thread loop until kill_event is set"""
+    logging.getLogger("sleekxmpp").setLevel(60)  # Disable sleekxmpp logging, as main.py does
+    logging.basicConfig(level=logging.INFO)
+    connector_class(**kwargs).run()
+
+
+class ConnectorSupervisor(Thread):
+    """Starts a child process per connector spec and restarts any that exit before kill_event is set"""
+    def __init__(self, kill_event, specs, restart_delay=5, max_restart_delay=300, stop_timeout=5):
+        super().__init__()
+        self.kill_event = kill_event
+        # {name: {'spec': (class, kwargs), 'process': Process, 'restarts': -, 'delay': -, 'restart_at': -}, ...}
+        self.children = {}
+        for connector_class, kwargs in specs:
+            name = kwargs.get('account') or kwargs.get('name')
+            self.children[name] = {'spec': (connector_class, kwargs), 'process': None, 'restarts': 0,
+                                   'delay': restart_delay, 'restart_at': 0, 'started_at': 0}
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+
+    def start_child(self, name):
+        child = self.children[name]
+        connector_class, kwargs = child['spec']
+        process = multiprocessing.Process(target=run_connector, args=(name, connector_class, kwargs),
+                                          name='connector '+name)
+        process.daemon = True
+        process.start()
+        child['process'] = process
+        child['started_at'] = time.monotonic()
+        logger.info('Connector process started: %s, pid %s', name, process.pid)
+
+    def check_children(self):
+        now = time.monotonic()
+        for name, child in self.children.items():
+            process = child['process']
+            if process is not None and process.is_alive():
+                if now - child['started_at'] > self.max_restart_delay:
+                    child['delay'] = self.restart_delay  # Stayed up long enough, forgive earlier crashes
+                continue
+            if process is not None:  # Crashed, back off before the next start
+                logger.warning('Connector process ended: %s, exit code %s', name, process.exitcode)
+                child['process'] = None
+                child['restarts'] += 1
+                child['restart_at'] = now + child['delay']
+                child['delay'] = min(child['delay'] * 2, self.max_restart_delay)
+            if now >= child['restart_at']:
+                self.start_child(name)
+
+    def stop_children(self):
+        for name, child in self.children.items():
+            process = child['process']
+            if process is None:
+                continue
+            process.join(self.stop_timeout)  # The connector disconnects and returns once kill_event is set
+            if process.is_alive():
+                logger.warning('Connector process did not stop, terminating: %s', name)
+                process.terminate()
+                process.join()
+
+    def status(self):
+        """{name: {'alive':-, 'restarts': crashes so far}, ...} for the admin interface's 'connections' command"""
+        return {name: {'alive': child['process'] is not None and child['process'].is_alive(),
+                       'restarts': child['restarts']} for name, child in list(self.children.items())}
+
+    def run(self):
+        while not self.kill_event.is_set():  # main thread loop
+            self.check_children()
+            self.kill_event.wait(1)
+        self.stop_children()
+        logger.info('Thread ending: %s', 'ConnectorSupervisor')
+        return
@@ -0,0 +1,197 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Envelope formats sent over inter_com, all json:
+#   Legacy RSA:  {'messages': [b64 RSA-OAEP block, ...], 'UUID': uuid, 'to': 'alice/bob'}
+#   AES session: {'mode': 'aes-gcm', 'nonce': b64, 'messages': [b64 ciphertext+tag], 'UUID': uuid, 'to': 'alice/bob'}
+#   AES group:   {'mode': 'aes-gcm-group', 'epoch': n, 'nonce': b64, 'messages': [b64 ciphertext+tag], 'UUID': uuid, 'to': 'bob'}
+# Session envelopes authenticate 'UUID:to' as associated data so they can't be replayed to another client
+# or reflected back to the sender. Group envelopes carry identical ciphertext for every recipient and
+# authenticate 'group:epoch:to' instead.
+# Clients may add an unencrypted 'hint': 'control' to envelopes carrying probeACK, ringACK or key messages,
+# Dispatch handles those ahead of queued chat traffic.
+
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+import time
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+RSA_BLOCK_SIZE = 214  # Max RSA-OAEP plaintext bytes for a 2048 bit key with SHA-1
+SESSION_MODE = 'aes-gcm'
+GROUP_MODE = 'aes-gcm-group'
+GCM_TAG_SIZE = 16
+
+
+def rsa_encrypt_blocks(cipher, data):
+    """Encrypts bytes in RSA sized blocks, returns a list of base64 strings"""
+    # Slice the encoded bytes, not the text, so multi-byte characters can't overflow a block.
+    return [base64.standard_b64encode(cipher.encrypt(data[x:x+RSA_BLOCK_SIZE])).decode('utf')
+            for x in range(0, max(len(data), 1), RSA_BLOCK_SIZE)]
+
+
+def rsa_decrypt_blocks(cipher, parts):
+    return b''.join(cipher.decrypt(base64.b64decode(part)) for part in parts)
+
+
+def key_fingerprint(pem):
+    if isinstance(pem, str):
+        pem = bytes(pem, encoding='utf')
+    return hashlib.sha256(b''.join(pem.split())).hexdigest()
+
+
+class CipherCache(object):
+    """Imported RSA ciphers keyed by public key fingerprint, with LRU and idle-TTL eviction.
+
+    Keys held by connected clients are pinned and only become idle once every holder has released them.
+    """
+    def __init__(self, max_size=1024, idle_ttl=3600, sweep_interval=60):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.entries = OrderedDict()  # {fingerprint: {'cipher':-, 'users':-, 'last_used':-}, ...} oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_sweep = time.time()
+
+    def get(self, pem):
+        fingerprint, entry = self.lookup(pem)
+        self.trim(keep=fingerprint)
+        return entry['cipher']
+
+    def acquire(self, pem):
+        """Pins a client's key while it is connected, returns the fingerprint to release it with"""
+        fingerprint, entry = self.lookup(pem)
+        entry['users'] += 1  # Pinned before trimming, so it can't be the key evicted
+        self.trim()
+        return fingerprint
+
+    def lookup(self, pem):
+        """(fingerprint, entry) of the key, imported if it isn't cached. Doesn't trim the cache."""
+        now = time.time()
+        if now - self.last_sweep > self.sweep_interval:
+            self.sweep(now)
+        fingerprint = key_fingerprint(pem)
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            self.misses += 1
+            entry = {'cipher': PKCS1_OAEP.new(RSA.importKey(pem)), 'users': 0, 'last_used': now}
+            self.entries[fingerprint] = entry
+        else:
+            self.hits += 1
+            entry['last_used'] = now
+            self.entries.move_to_end(fingerprint)
+        return fingerprint, entry
+
+    def release(self, fingerprint):
+        entry = self.entries.get(fingerprint)
+        if entry is not None and entry['users'] > 0:
+            entry['users'] -= 1
+            entry['last_used'] = time.time()  # Idle time counts from the last holder leaving
+
+    def trim(self, keep=None):
+        # Least recently used unpinned keys go first. keep is the key just looked up, still in use by the caller.
+        # With every other key pinned the cache stays over max_size until clients disconnect.
+        for fingerprint in list(self.entries):
+            if len(self.entries) <= self.max_size:
+                break
+            if self.entries[fingerprint]['users'] == 0 and fingerprint != keep:
+                self.entries.pop(fingerprint)
+                self.evictions += 1
+
+    def sweep(self, now):
+        self.last_sweep = now
+        for fingerprint, entry in list(self.entries.items()):
+            if entry['users'] == 0 and now - entry['last_used'] > self.idle_ttl:
+                self.entries.pop(fingerprint)
+                self.evictions += 1
+
+    def stats(self):
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+# RSA keys imported in this process, so a process only parses each key once.
+# Crypto worker processes each get their own copy.
+cipher_cache = CipherCache()
+
+
+def rsa_cipher(pem):
+    return cipher_cache.get(pem)
+
+
+# Job functions take only picklable arguments so they can run on a crypto worker process.
+def rsa_encrypt_job(pem, data, uuid):
+    """Returns the legacy json envelope for data encrypted to the client's public key"""
+    return json.dumps({'messages': rsa_encrypt_blocks(rsa_cipher(pem), data), 'UUID': uuid, 'to': 'bob'})
+
+
+def rsa_decrypt_job(pem, parts):
+    """Returns the message dict from a legacy envelope's blocks"""
+    return json.loads(rsa_decrypt_blocks(rsa_cipher(pem), parts).decode('utf'))
+
+
+class SessionCipher(object):
+    """AES-GCM cipher for the symmetric key negotiated with one client"""
+    mode = SESSION_MODE
+
+    def __init__(self, key=None):
+        self.key = key or get_random_bytes(32)
+
+    def encrypt(self, data, associated_data):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=get_random_bytes(12))
+        cipher.update(associated_data)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return cipher.nonce, ciphertext + tag
+
+    def decrypt(self, nonce, data, associated_data):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(associated_data)
+        return cipher.decrypt_and_verify(data[:-GCM_TAG_SIZE], data[-GCM_TAG_SIZE:])
+
+    def key_b64(self):
+        return base64.standard_b64encode(self.key).decode('utf')
+
+
+class GroupCipher(SessionCipher):
+    """AES-GCM key shared by every session client, so a broadcast is only encrypted once"""
+    mode = GROUP_MODE
+
+    def __init__(self, epoch, key=None):
+        super().__init__(key)
+        self.epoch = epoch
+        self.created = time.time()
+
+    def group_id(self):
+        return 'group:%d' % self.epoch
+
+
+def associated_data(uuid, to):
+    return bytes(uuid+':'+to, encoding='utf')
+
+
+def seal_envelope(session, data, uuid, to):
+    """Encrypts bytes under a session cipher, returns the envelope dict"""
+    nonce, ciphertext = session.encrypt(data, associated_data(uuid, to))
+    return {'mode': session.mode, 'nonce': base64.standard_b64encode(nonce).decode('utf'),
+            'messages': [base64.standard_b64encode(ciphertext).decode('utf')], 'UUID': uuid, 'to': to}
+
+
+def seal_group_envelope(group, data, to):
+    """Encrypts bytes once under the group cipher, the caller sets UUID per recipient"""
+    envelope = seal_envelope(group, data, group.group_id(), to)
+    envelope['epoch'] = group.epoch
+    return envelope
+
+
+def open_envelope(session, envelope):
+    """Decrypts a session envelope dict, raises ValueError if it fails authentication"""
+    return session.decrypt(base64.b64decode(envelope['nonce']), base64.b64decode(envelope['messages'][0]),
+                           associated_data(envelope['UUID'], envelope['to']))
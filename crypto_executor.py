@@ -0,0 +1,84 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+from collections import deque
+import concurrent.futures
+import multiprocessing
+import logging
+logger = logging.getLogger(__name__)
+
+
+class InlineCryptoExecutor(object):
+    """Runs crypto jobs straight away on the calling thread"""
+    def __init__(self):
+        self.ready_queue = multiprocessing.Queue()  # Never used, kept so both executors look the same to Dispatch
+
+    def submit(self, uuid, func, args, callback):
+        try:
+            result = func(*args)
+        except Exception:
+            logger.debug('Crypto job failed for: %s', uuid, exc_info=True)
+            result = None
+        callback(result)
+
+    def submit_done(self, uuid, result, callback):
+        callback(result)
+
+    def complete(self, uuid):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class ProcessCryptoExecutor(object):
+    """Runs crypto jobs on a process pool.
+
+    Callbacks always run on the thread that calls complete(), in the order the jobs were submitted
+    for each uuid. The uuid of every finished job is put on ready_queue to wake that thread.
+    """
+    def __init__(self, workers):
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.ready_queue = multiprocessing.Queue()
+        self.pending = {}  # {uuid: deque([(future, callback), ...]), ...}
+
+    def submit(self, uuid, func, args, callback):
+        future = self.pool.submit(func, *args)
+        self.pending.setdefault(uuid, deque()).append((future, callback))
+        future.add_done_callback(lambda _: self.ready_queue.put(uuid))
+
+    def submit_done(self, uuid, result, callback):
+        """Queues an already computed result behind any of the uuid's jobs still running"""
+        if uuid not in self.pending:
+            callback(result)
+            return
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        self.pending[uuid].append((future, callback))
+
+    def complete(self, uuid):
+        jobs = self.pending.get(uuid)
+        while jobs and jobs[0][0].done():
+            future, callback = jobs.popleft()
+            try:
+                result = future.result()
+            except Exception:
+                logger.debug('Crypto job failed for: %s', uuid, exc_info=True)
+                result = None
+            callback(result)
+        if not jobs:
+            self.pending.pop(uuid, None)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+def make_crypto_executor(workers):
+    if workers > 0:
+        logger.info('Crypto process pool with %d workers', workers)
+        return ProcessCryptoExecutor(workers)
+    return InlineCryptoExecutor()
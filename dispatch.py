@@ -8,13 +8,27 @@
 
 import json
 from admin_debug_interface import AdminDebugInterface
+from session_registry import SessionRegistry
+from ring_router import RingRouter
+from ring_table import Ring, RingTable
+from waiting_room import WaitingRoom
+from dispatch_snapshot import save_snapshot, load_snapshot
+from chat_state_stage import ChatStateStage
+from overload import queue_depth, count_rejected
+from crypto_channel import SessionCipher, GroupCipher, SESSION_MODE, GROUP_MODE, cipher_cache, rsa_cipher, \
+    rsa_encrypt_job, rsa_decrypt_job, seal_envelope, seal_group_envelope, open_envelope, associated_data
+from compact_envelope import COMPACT_MODE, FLAG_CONTROL, compress, decompress, pack, unpack, peek, encode_body
+from crypto_executor import make_crypto_executor, InlineCryptoExecutor
 from threading import Thread, Lock
-from timeout_thread import TimeoutThreadDisableQueue, MultiTimeoutThreadQueue
+from timeout_thread import TimerWheel
 import multiprocessing
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
-import time
+import multiprocessing.connection
+import queue
+from collections import deque
+import functools
 import base64
+import os
+import time
 import logging
 import html
 logger = logging.getLogger(__name__)
@@ -22,52 +36,117 @@ logger = logging.getLogger(__name__)
 
 class Dispatch(Thread):
     def __init__(self, kill_event, root, options, incoming_queue, outgoing_queue,
-                 fb_queue_in, fb_queue_out, zoho_queue_in, zoho_queue_out, inter_com_queue_in, inter_com_queue_out):
+                 service_queues, inter_com_queue_in, inter_com_queue_out,
+                 messages_rejected=None, high_water=5000, connection_health=None):
         super().__init__()
         self.kill_event = kill_event
         self.root = root
         self.options = options
         self.incoming_queue = incoming_queue
         self.outgoing_queue = outgoing_queue
-        self.fb_queue_in = fb_queue_in
-        self.fb_queue_out = fb_queue_out
-        self.zoho_queue_in = zoho_queue_in
-        self.zoho_queue_out = zoho_queue_out
+        self.service_queues = service_queues  # {service: service_connector.ServiceQueues, ...}
         self.inter_com_queue_in = inter_com_queue_in
         self.inter_com_queue_out = inter_com_queue_out
         self.service_status = []  # [{'name': service, 'status': status}, ...]
-        self.address_client_list = []  # [{'service': 'asdf', 'address': 'asdf@asdf.net', 'UUID': 'uuid'}, ...]
+        # inter_com connection states are only for the admin interface, clients are sent service_status.
+        self.connection_status = {}  # {inter_com connection name: last state it reported, ...}
+        # Callable returning {'inter_com': {connection name: {'up':-, 'sent':-, 'dropped':-}, ...}}, see
+        # InterComPool.health, plus 'connector_processes' with ConnectorSupervisor.status() when connectors run
+        # as child processes.
+        self.connection_health = connection_health or dict
+        # Active clients and their address associations, indexed by address and by UUID.
+        self.sessions = SessionRegistry(int(options.get('max_client_capacity', 5)))
         self.modules_without_chat_states = options['modules_without_chat_states']
-
-        # {'lock':lock, 'list': [{'ID':-, 'address':-, 'text':-,'service':-, 'timeout_handle':-}, ...]}
-        self.ring_queue = {'lock': Lock(), 'list': []}
+        # Max messages handled from one inbound queue per wakeup, so one busy service can't starve the others.
+        self.batch_size = int(options.get('dispatch_batch_size', 50))
+
+        # Inter_com envelopes are read ahead and sorted before decryption, so liveness and ring acceptance
+        # messages flagged as control by the client are handled ahead of a chat backlog.
+        self.inter_com_control = deque()
+        self.inter_com_bulk = deque()  # deque([(uuid, envelope), ...])
+        self.bulk_pending = {}  # {uuid: envelopes of that client in inter_com_bulk, ...}
+
+        # Texts for a client are held for coalesce_window seconds and sent together in one 'msg' list.
+        self.coalesce_window = int(options.get('coalesce_window_ms', 50)) / 1000
+        # {uuid: {'msg': {conversation ID: [text, ...], ...}, 'deadline': monotonic time}, ...} Ordered by deadline.
+        self.pending_texts = {}
+        # User chat states are debounced and rate limited per address before being encrypted for a client.
+        self.chat_states = ChatStateStage(int(options.get('chat_state_debounce_ms', 300)) / 1000,
+                                          int(options.get('chat_state_interval_ms', 1000)) / 1000)
+
+        # Rings waiting for a client by ID and by address, they expire and widen on the timer wheel.
+        self.rings = RingTable()
         self.ring_counter = 0
+        self.ring_router = RingRouter(self.sessions, int(options.get('ring_fanout', 3)),
+                                      int(options.get('ring_widen_after', 10)))
+        # New users wait here while every client is full, and are told their position every
+        # waiting_room_update_interval seconds as it improves.
+        self.waiting_room = WaitingRoom(int(options.get('waiting_room_size', 50)),
+                                        int(options.get('waiting_room_max_wait', 300)))
+        self.waiting_update_interval = int(options.get('waiting_room_update_interval', 30))
+        self.waiting_update_handle = None
 
         # Timed-out clients go in the grace_clients for n seconds.
         # All messages to these clients get redirected to a cache.
-        # {'UUID': {'msg_cache':[], 'timeout_handle':-}, ...}
+        # {'UUID': {'msg_cache':[(conversation ID, text), ...], 'timeout_handle':TimerHandle}, ...}
         self.grace_clients = {}
 
         self.time_event_queue = multiprocessing.Queue()
-
-        # Contains only active clients
-        self.active_clients = {'lock': Lock(), 'list': []}  # {'lock':lock, 'list': [uuid1, uuid2, ...]}
+        # Every ring, grace and client liveness timer shares this wheel, which fires into time_event_queue.
+        self.timers = TimerWheel(self.time_event_queue)
+        self.timers.daemon = True
 
         # All clients, including implied disconnected clients. Excludes explicitly disconnected clients.
         self.clients = {'lock': Lock(), 'dict': {}}
-        # {'lock':lock, 'dict': {uuid: {'timeout': handle, 'lock': semaphore_lock}, ...}}
-
-        self.client_ciphers = {}  # [uuid: cipher_object, ...]
-        self.alices_cypher = PKCS1_OAEP.new(RSA.importKey(options['alice_private_key']))
+        # {'lock':lock, 'dict': {uuid: {'probe': TimerHandle, 'timeout': TimerHandle}, ...}}
+        # 'probe' sends an encrypted probe to every client. 'presence' follows the clients' XMPP presence and
+        # pings them with XEP-0199, the encrypted probe is only used when presence is unknown or a ping fails.
+        self.liveness = options.get('liveness', 'probe')
+        self.presence = {}  # {uuid: True, ...} Client resources seen online
+
+        self.client_keys = {}  # {uuid: public key pem, ...}
+        self.client_key_fingerprints = {}  # {uuid: fingerprint pinned in cipher_cache, ...}
+        cipher_cache.max_size = int(options.get('cipher_cache_size', 1024))
+        cipher_cache.idle_ttl = int(options.get('cipher_cache_ttl', 3600))
+        # AES-GCM session ciphers for clients that negotiated one at the 'key' handshake.
+        self.client_sessions = {}  # {uuid: SessionCipher, ...}
+        # Broadcasts to session clients that support it are encrypted once under a shared group key.
+        # The key is rotated when a member disconnects and after group_key_lifetime seconds.
+        self.group_capable = set()  # uuids that listed GROUP_MODE at the handshake
+        self.group_members = set()  # uuids holding the current group key
+        self.group_cipher = None
+        self.group_epoch = 0
+        self.group_key_lifetime = int(options.get('group_key_lifetime', 3600))
+        self.compact_clients = set()  # Session clients that negotiated the compact binary envelope
+        self.alice_key = options['alice_private_key']
+        rsa_cipher(self.alice_key)  # Fail at start up on a bad server key, not on the first message
+
+        # RSA work runs on a process pool when crypto_workers > 0, otherwise inline on this thread.
+        self.crypto = make_crypto_executor(int(options.get('crypto_workers', 0)))
 
         # Stats
-        self.messages_rejected = 0
-        self.admin_debug_interface = AdminDebugInterface(self.service_status, self.clients, self.active_clients,
-                                                         self.address_client_list, self.ring_queue)
+        # Shared with the connections' InboundGates, which count what they shed in it as well.
+        self.messages_rejected = messages_rejected or multiprocessing.Value('i', 0)
+        # Above this many waiting messages in any inbound queue Dispatch is overloaded and sheds load too.
+        self.high_water = high_water
+        self.outbound_metrics = {}  # {service: {lane: {'depth':-, 'sent':-, ...}, ...}, ...} Sent by connectors
+        self.admin_debug_interface = AdminDebugInterface(self.service_status, self.clients, self.sessions,
+                                                         self.rings, cipher_cache, self.outbound_metrics,
+                                                         self.load_stats, self.connection_stats)
         self.potential_admin = {'service': '', 'address': ''}
         self.admin = {'service': '', 'address': ''}
 
+        # Conversations, rings and client keys survive a restart through this file, see dispatch_snapshot.
+        # snapshot_interval = 0 turns snapshots off.
+        self.snapshot_path = os.path.join(root, options.get('snapshot_file', 'dispatch_state.snapshot'))
+        self.snapshot_interval = int(options.get('snapshot_interval', 30))
+        self.snapshot_max_age = int(options.get('snapshot_max_age', 300))
+        self.snapshot_keys = int(options.get('snapshot_keys', 0)) > 0  # Client and session keys in plain text
+
     def time_event_handler(self, time_event):
+        if not self.timers.is_current(time_event['generation']):
+            logger.debug('Stale timer event %s ignored', time_event['name'])  # Cancelled or re-armed since
+            return
         getattr(self, time_event['name'])(time_event['arg'])
         return
 
@@ -85,31 +164,44 @@ class Dispatch(Thread):
         logger.info('Service status changed: %s, %s', service, status)
         self.send_status_to_clients()
 
+    def update_connection_status(self, msg):
+        name, status = msg
+        self.connection_status[name] = status
+        logger.info('inter_com connection status changed: %s, %s', name, status)
+
+    def connection_stats(self):
+        stats = self.connection_health()
+        for name, health in stats.get('inter_com', {}).items():
+            health['state'] = self.connection_status.get(name, 'unknown')
+        return stats
+
     def update_active_client_timers(self, uuid):
         self.clients['lock'].acquire_lock()
-        try:
-            if self.clients['dict'][uuid]['timeout'].isAlive():
-                logger.debug('Client alive update for: %s', uuid)
-                self.clients['dict'][uuid]['timeout'].set_times_reset(10, 20)
-            else:
-                raise KeyError
-        except KeyError:
+        timers = self.clients['dict'].get(uuid)
+        if timers is not None and timers['timeout'].is_pending():
+            logger.debug('Client alive update for: %s', uuid)
+            timers['probe'].reschedule(10)
+            timers['timeout'].reschedule(20)
+        else:
+            if timers is not None:  # Its timeout fired, void the event if it is still queued
+                timers['probe'].cancel()
+                timers['timeout'].cancel()
             if uuid in self.grace_clients:
-                self.grace_clients[uuid]['timeout_handle'].disable()
-                msg = json.dumps({'type': 'msg', 'msg': self.grace_clients[uuid]['msg_cache'],
-                                  'I/O': 'in', 'UUID': uuid})
-                self.encrypt_and_send(msg, uuid)
+                self.grace_clients[uuid]['timeout_handle'].cancel()
+                for conversation, text in self.grace_clients[uuid]['msg_cache']:
+                    self.send_texts_to_client(uuid, [text], conversation)
                 self.grace_clients.pop(uuid)
-            logger.debug('Client alive thread creation for: %s', uuid)
-            #  timeout = MultiTimeoutThread(lock, (10, 20), (self.probe_client, self.client_timed_out), uuid)
-            callbacks = ("probe_client", "client_timed_out")
-            timeout = MultiTimeoutThreadQueue(self.time_event_queue, (10,20), callbacks, uuid)
-            timeout.daemon = True
-            timeout.start()
-            self.clients['dict'][uuid] = {'timeout': timeout}
+            logger.debug('Client alive timer creation for: %s', uuid)
+            self.clients['dict'][uuid] = {'probe': self.timers.schedule(10, "probe_client", uuid),
+                                          'timeout': self.timers.schedule(20, "client_timed_out", uuid)}
         self.clients['lock'].release_lock()
 
     def probe_client(self, uuid):
+        if self.liveness == 'presence' and self.presence.get(uuid):
+            # Online by its presence, an unencrypted XEP-0199 ping through its inter_com connection is enough.
+            logger.debug('Ping client: %s', uuid)
+            self.inter_com_queue_out.put((None, uuid))
+            return
         msg = json.dumps({'type': 'probe', 'UUID': uuid})
         logger.debug('Probe client: %s', uuid)
         self.encrypt_and_send(msg, uuid)
@@ -117,21 +209,44 @@ class Dispatch(Thread):
     def client_probeACK(self, msg):
         pass
 
+    def liveness_event(self, msg):
+        """Presence and ping results from the inter_com connections, only used with 'liveness = presence'"""
+        if self.liveness != 'presence':
+            return
+        uuid = msg['UUID']
+        known = uuid in self.clients['dict'] or uuid in self.grace_clients
+        if msg['type'] == 'presence':
+            if msg['available']:
+                self.presence[uuid] = True
+                if known:
+                    self.update_active_client_timers(uuid)
+                return
+            self.presence.pop(uuid, None)
+            timers = self.clients['dict'].get(uuid)
+            if timers is not None and timers['timeout'].is_pending():
+                self.client_timed_out(uuid)  # Gone, no need to wait for the probe to fail
+        elif msg['type'] == 'ping' and known:
+            if msg['alive']:
+                self.update_active_client_timers(uuid)
+            else:  # Presence says online but the ping failed, ask the client itself
+                self.presence.pop(uuid, None)
+                self.probe_client(uuid)
+
     def client_timed_out(self, uuid):
-        logger.info('Client timed out: %s', uuid)
         self.clients['lock'].acquire_lock()
-        self.clients['dict'][uuid]['timeout'].disable()
+        timers = self.clients['dict'].get(uuid)
+        if timers is not None:
+            timers['probe'].cancel()
+            timers['timeout'].cancel()
         self.clients['lock'].release_lock()
+        if timers is None:  # Disconnected while its timeout was waiting to be handled
+            return
+        logger.info('Client timed out: %s', uuid)
         # TODO pop this off the list after the probe thread had sent 'probe' command.
-        for association in self.address_client_list:
-            if association['UUID'] == uuid:
-                #  self.outgoing_dispatch((association['service'], association['address'],
-                #                        self.options['messages']['client_dropped'], 'active'))
-                logger.info('Client timed-out during conversation: %s', uuid)
+        if self.sessions.find_uuid(uuid) is not None:
+            logger.info('Client timed-out during conversation: %s', uuid)
         #  Start disconnect timer.
-        timeout = TimeoutThreadDisableQueue(self.time_event_queue, 60, "client_disconnect", uuid)
-        timeout.daemon = True
-        timeout.start()
+        timeout = self.timers.schedule(60, "client_disconnect", uuid)
         #  Add client to grace_clients dict
         self.grace_clients.update({uuid:{'msg_cache': [], 'timeout_handle': timeout}})
 
@@ -140,166 +255,384 @@ class Dispatch(Thread):
         self.send_to_all_clients(msg)
 
     def send_to_all_clients(self, msg):
-        self.active_clients['lock'].acquire_lock()
-        for client_address in self.active_clients['list']:
-            self.encrypt_and_send(msg, client_address)
-        self.active_clients['lock'].release_lock()
+        # Fan-out works on a snapshot so the client lock isn't held while encrypting and sending.
+        self.send_to_clients(msg, self.sessions.active_list())
+
+    def send_to_clients(self, msg, recipients):
+        recipients = [uuid for uuid in recipients if self.sessions.is_active(uuid)]
+        for uuid in recipients:
+            if uuid in self.pending_texts:
+                self.flush_texts(uuid)
+        group_recipients = [uuid for uuid in recipients if uuid in self.group_capable]
+        if group_recipients:
+            self.refresh_group_key(group_recipients)
+            data = bytes(msg, encoding='utf')
+            envelope, compact = None, None  # Each format is encrypted at most once
+            for uuid in group_recipients:
+                if uuid in self.compact_clients:
+                    if compact is None:
+                        flags, payload = compress(data)
+                        nonce, sealed = self.group_cipher.encrypt(payload,
+                                                                  associated_data(self.group_cipher.group_id(), 'bob'))
+                        compact = (flags, nonce, sealed)
+                    body = encode_body(pack(compact[0], uuid, compact[1], compact[2], self.group_cipher.epoch))
+                else:
+                    if envelope is None:
+                        envelope = seal_group_envelope(self.group_cipher, data, 'bob')
+                    envelope['UUID'] = uuid
+                    body = json.dumps(envelope)
+                self.crypto.submit_done(uuid, body, functools.partial(self.send_envelope, uuid))
+        for uuid in recipients:
+            if uuid not in self.group_capable:
+                self.encrypt_and_send(msg, uuid)
+
+    def refresh_group_key(self, recipients):
+        """Rotates the group key if it is stale and makes sure every recipient holds it"""
+        if self.group_cipher is None or time.time() - self.group_cipher.created > self.group_key_lifetime:
+            self.group_epoch += 1
+            self.group_cipher = GroupCipher(self.group_epoch)
+            self.group_members = set()
+            logger.debug('Group key rotated to epoch %d', self.group_epoch)
+        key_msg = json.dumps({'type': 'group_key', 'mode': self.group_cipher.mode, 'epoch': self.group_epoch,
+                              'key': self.group_cipher.key_b64()})
+        for uuid in recipients:
+            if uuid not in self.group_members:
+                self.encrypt_and_send(key_msg, uuid)  # Sent under the client's own session key
+                self.group_members.add(uuid)
+
+    def leave_group(self, uuid):
+        self.group_capable.discard(uuid)
+        if uuid in self.group_members:
+            self.group_cipher = None  # Don't let a departed client read later broadcasts
+            self.group_members = set()
 
     def send_ring_to_clients(self, msg, service):
-        #self.ring_queue['lock'].acquire_lock()
-        for x in range(0, len(self.ring_queue['list'])):
-            if self.ring_queue['list'][x]['address'] == msg[1]:  # Already in the ring list
-                self.ring_queue['list'][x]['text'].append(msg[2])
-                return
+        ring = self.rings.find_address(msg[1])
+        if ring is not None:  # Already ringing
+            ring.text.append(msg[2])
+            return
+        self.start_ring(msg[1], service, [msg[2]])
+
+    def start_ring(self, address, service, texts):
         logger.info('Sending ring ID%d to clients', self.ring_counter)
-        #lock = Lock()
-        ring_counter = self.ring_counter
-        #timeout = TimeoutThreadDisable(lock, 60, self.ring_timed_out, ring_counter)
-        timeout = TimeoutThreadDisableQueue(self.time_event_queue, 60, "ring_timed_out", ring_counter)
-        timeout.daemon = True
-        timeout.start()
-        self.ring_queue['list'].append({'ID': ring_counter, 'address': msg[1], 'text': [msg[2]],
-                                        'service': service, 'timeout_handle': timeout})
-        #self.ring_queue['lock'].release_lock()
-        msg = json.dumps({'type': 'ring', 'group': '', 'ID': self.ring_counter, 'time': (time.time()+55)})
-        self.send_to_all_clients(msg)
+        ring = Ring(self.ring_counter, address, service, self.ring_router.ring_group(service), time.time()+55, texts)
+        ring.timeout_handle = self.timers.schedule(60, "ring_timed_out", ring.ID)
+        self.rings.add(ring)
         self.ring_counter += 1
+        self.ring_clients(ring)
+
+    def ring_clients(self, ring):
+        """Rings the ring's next wave of candidates and schedules the wave after it"""
+        wave = self.ring_router.next_wave(ring.group, ring.rung, ring.wave)
+        if wave:
+            ring.wave += 1
+            ring.rung.update(wave)
+            logger.debug('Ring ID%d wave %d to %d clients', ring.ID, ring.wave, len(wave))
+            msg = json.dumps({'type': 'ring', 'group': ring.group, 'ID': ring.ID, 'time': ring.expires})
+            self.send_to_clients(msg, wave)
+        # Also rechecked with nobody left to ring, clients may have connected or become free since.
+        ring.widen_handle = self.timers.schedule(self.ring_router.widen_after, "ring_widen", ring.ID)
+
+    def ring_widen(self, ring_id):
+        ring = self.rings.get(ring_id)
+        if ring is not None:
+            self.ring_clients(ring)
 
     def ring_timed_out(self, ring_id):
+        ring = self.rings.pop(ring_id)
+        if ring is None:  # Answered just before its timer fired
+            return
         logger.info('Ring timed out ID%d', ring_id)
         msg = json.dumps({'type': 'ringACKACK', 'ID': ring_id, 'UUID': ''})
-        self.send_to_all_clients(msg)
-        #self.ring_queue['lock'].acquire_lock()
-        for x in range(0, len(self.ring_queue['list'])):
-            if self.ring_queue['list'][x]['ID'] == ring_id:
-                ring_item = self.ring_queue['list'].pop(x)
-                self.outgoing_dispatch((ring_item['service'], ring_item['address'],
-                                        self.options['messages']['ring_timed_out'], 'active'))
-        #self.ring_queue['lock'].release_lock()
+        self.send_to_clients(msg, ring.rung)
+        self.outgoing_dispatch((ring.service, ring.address, self.options['messages']['ring_timed_out'], 'active'))
+        self.admit_waiting()  # Nobody answered, but the ring no longer holds a place
 
     def client_initialisation(self, msg):
         logger.info('Client Connected: %s', msg['UUID'])
-        try:
-            cipher_object = PKCS1_OAEP.new(RSA.importKey(bytes(msg['key'], encoding='utf')))
-        except:
-            cipher_object = False
-        self.client_ciphers[msg['UUID']] = cipher_object
+        # The key is imported by the crypto executor the first time it is used.
+        self.pin_client_key(msg['UUID'], msg['key'])
+        self.client_sessions.pop(msg['UUID'], None)  # A new handshake always starts in the legacy format
+        self.compact_clients.discard(msg['UUID'])
+        self.leave_group(msg['UUID'])
+        modes = msg.get('modes', [])
+        if SESSION_MODE in modes:
+            accepted = [SESSION_MODE] + [mode for mode in (GROUP_MODE, COMPACT_MODE) if mode in modes]
+            self.start_session(msg['UUID'], accepted)
+            if GROUP_MODE in modes:
+                self.group_capable.add(msg['UUID'])
+            if COMPACT_MODE in modes:
+                self.compact_clients.add(msg['UUID'])
+        self.sessions.set_groups(msg['UUID'], msg.get('groups', []))  # Ring groups it takes, all by default
+        self.sessions.set_capacity(msg['UUID'], msg.get('capacity', 1))  # Conversations it takes at once
         self.add_to_clients(msg['UUID'])
-        # To encrypt a message
-        # encrypted_msg = self.client_ciphers[msg['UUID']].encrypt(bytes(message, encoding='utf'))
-        # message = base64.standard_b64encode(encrypted_msg).decode('utf')
+
+    def pin_client_key(self, uuid, key):
+        self.client_keys[uuid] = key
+        self.release_client_key(uuid)
+        if isinstance(self.crypto, InlineCryptoExecutor):  # Only the inline cache is in this process
+            try:
+                self.client_key_fingerprints[uuid] = cipher_cache.acquire(key)
+            except (ValueError, IndexError, TypeError):
+                logger.info('Invalid public key from: %s', uuid)
+
+    def start_session(self, uuid, modes):
+        # The session key travels in the RSA format, everything after it is AES-GCM.
+        session = SessionCipher()
+        key_msg = json.dumps({'type': 'session_key', 'mode': session.mode, 'modes': modes, 'key': session.key_b64(),
+                              'UUID': uuid})
+        self.encrypt_and_send(key_msg, uuid)
+        self.client_sessions[uuid] = session
+        logger.debug('Session mode %s started for: %s', session.mode, uuid)
 
     def encrypt_and_send(self, msg, uuid):
-        try:
-            messages = []
-            chars = len(msg)
-            x = 0
-            while True:
-                if chars > 214:
-                    messages.append(
-                        base64.standard_b64encode(
-                            self.client_ciphers[uuid].encrypt(bytes(msg[214*x:214*(x+1)], encoding='utf'))
-                        ).decode('utf')
-                    )
-                    x += 1
-                    chars -= 214
-                else:
-                    messages.append(
-                        base64.standard_b64encode(
-                            self.client_ciphers[uuid].encrypt(bytes(msg[214*x:len(msg)], encoding='utf'))
-                        ).decode('utf')
-                    )
-                    break
-            message = json.dumps({'messages': messages, 'UUID': uuid, 'to': 'bob'})
-            self.inter_com_queue_out.put((message, uuid))
-        except:
+        # AES is cheap enough to do here, RSA goes to the crypto executor.
+        # Both are queued per uuid so envelopes leave in the order they were sent.
+        if uuid in self.pending_texts:
+            self.flush_texts(uuid)  # Coalesced texts were sent first, keep them first
+        callback = functools.partial(self.send_envelope, uuid)
+        data = bytes(msg, encoding='utf')
+        if uuid in self.client_sessions:
+            session = self.client_sessions[uuid]
+            if uuid in self.compact_clients:
+                flags, payload = compress(data)
+                nonce, sealed = session.encrypt(payload, associated_data(uuid, 'bob'))
+                body = encode_body(pack(flags, uuid, nonce, sealed))
+            else:
+                body = json.dumps(seal_envelope(session, data, uuid, 'bob'))
+            self.crypto.submit_done(uuid, body, callback)
+        elif uuid in self.client_keys:
+            self.crypto.submit(uuid, rsa_encrypt_job, (self.client_keys[uuid], data, uuid), callback)
+        else:
             logger.info("No uuid exists.")
 
+    def send_texts_to_client(self, uuid, texts, conversation=None):
+        # conversation is the ring ID of the user's conversation, sent as 'ID' so the client can tell them apart.
+        if not texts:
+            return
+        pending = self.pending_texts.get(uuid)
+        if pending is not None:
+            pending['msg'].setdefault(conversation, []).extend(texts)
+        elif self.coalesce_window > 0:
+            self.pending_texts[uuid] = {'msg': {conversation: list(texts)},
+                                        'deadline': time.monotonic()+self.coalesce_window}
+        else:
+            msg = json.dumps({'type': 'msg', 'msg': list(texts), 'I/O': 'in', 'UUID': uuid, 'ID': conversation})
+            self.encrypt_and_send(msg, uuid)
+
+    def flush_texts(self, uuid):
+        pending = self.pending_texts.pop(uuid)
+        for conversation, texts in pending['msg'].items():  # One msg envelope per conversation
+            msg = json.dumps({'type': 'msg', 'msg': texts, 'I/O': 'in', 'UUID': uuid, 'ID': conversation})
+            self.encrypt_and_send(msg, uuid)
+
+    def flush_due_texts(self):
+        """Sends every coalesced text whose window has closed, returns seconds until the next one does"""
+        now = time.monotonic()
+        for uuid, pending in list(self.pending_texts.items()):
+            if pending['deadline'] > now:
+                return pending['deadline'] - now
+            self.flush_texts(uuid)
+        return None
+
+    def send_envelope(self, uuid, envelope):
+        if envelope is None:
+            logger.info('Unable to encrypt message for: %s', uuid)
+            return
+        self.inter_com_queue_out.put((envelope, uuid))
+
     def decrypt_reconstruct(self, msg):
-        # {'messages': messages, 'UUID': uuid, 'to': 'alice/bob'}
+        # Legacy: {'messages': messages, 'UUID': uuid, 'to': 'alice/bob'}
         # messages is a list of base64 encoded byte arrays.
         # They are individually encrypted blocks that combine into a json message.
+        # Session: as above plus 'mode' and 'nonce', see crypto_channel.
+        # The decrypted message is passed to client_dispatch, in arrival order per uuid.
+        if msg.get('mode') == SESSION_MODE:
+            try:
+                message = json.loads(open_envelope(self.client_sessions[msg['UUID']], msg).decode('utf'))
+                if message['UUID'] != msg['UUID']:  # A client's session key only speaks for that client
+                    raise ValueError
+            except:
+                message = None
+            self.crypto.submit_done(msg['UUID'], message, self.client_dispatch)
+        else:
+            self.crypto.submit(msg['UUID'], rsa_decrypt_job, (self.alice_key, msg['messages']), self.client_dispatch)
+
+    def decrypt_compact(self, data):
+        # See compact_envelope for the layout. The ciphertext is decrypted straight from the received bytes.
         try:
-            message = b''
-            for part in msg['messages']:
-                message += self.alices_cypher.decrypt(base64.b64decode(part))
-            return json.loads(message.decode('utf'))
+            envelope = unpack(data)
+        except (ValueError, IndexError, UnicodeDecodeError):
+            logger.info('inter_com invalid message received')
+            return
+        if envelope.to != 'alice':
+            logger.debug('Message bounced back')
+            return
+        try:
+            payload = self.client_sessions[envelope.UUID].decrypt(envelope.nonce, envelope.sealed,
+                                                                  associated_data(envelope.UUID, 'alice'))
+            message = json.loads(decompress(envelope.flags, payload).decode('utf'))
+            if message['UUID'] != envelope.UUID:
+                raise ValueError
         except:
-            logger.info('Unable to decrypt message from: %s', msg['UUID'])  # TODO add proper logger warning
-            return False
+            message = None
+        self.crypto.submit_done(envelope.UUID, message, self.client_dispatch)
 
-    def client_disassociate_with_address(self, uuid):
+    def client_disassociate_with_address(self, uuid, conversation=None):
         logger.info('Client disassociating: %s', uuid)
-        for x in range(0, len(self.address_client_list)):
-            if self.address_client_list[x]['UUID'] == uuid:
-                self.address_client_list.pop(x)
-                break
+        self.end_conversations(uuid, conversation)
+        self.admit_waiting()  # The client has room again
+
+    def end_conversations(self, uuid, conversation=None):
+        for association in self.sessions.disassociate(uuid, conversation):
+            self.chat_states.forget(association.address)
 
     def client_disconnect(self, uuid):
         logger.info('Client disconnecting: %s', uuid)
-        for association in self.address_client_list:
-            if association['UUID'] == uuid:
-                self.outgoing_dispatch((association['service'], association['address'],
-                                        self.options['messages']['client_dropped'], 'active'))
-        self.client_disassociate_with_address(uuid)  # remove from active client list
-        try:
-            pass
-            #self.client_ciphers.pop(uuid)
-            # TODO pop this off the list after the probe thread had sent 'probe' command
-        except KeyError:
+        for association in self.sessions.conversations(uuid):
+            self.outgoing_dispatch((association.service, association.address,
+                                    self.options['messages']['client_dropped'], 'active'))
+        self.end_conversations(uuid)  # Not client_disassociate_with_address, it would admit users to this client
+        # Stop the liveness timers first so no probe is sent to a client without a key.
+        self.clients['lock'].acquire_lock()
+        timers = self.clients['dict'].pop(uuid, None)
+        self.clients['lock'].release_lock()
+        if timers is not None:
+            timers['probe'].cancel()
+            timers['timeout'].cancel()
+        if uuid in self.grace_clients:
+            self.grace_clients.pop(uuid)['timeout_handle'].cancel()
+        self.presence.pop(uuid, None)
+        if self.client_keys.pop(uuid, None) is None:
             logger.warning('Client already disconnected: %s', uuid)
-        self.active_clients['lock'].acquire_lock()
-        if self.active_clients['list'].count(uuid) > 0:
-            self.active_clients['list'].remove(uuid)
-        self.active_clients['lock'].release_lock()
+        self.client_sessions.pop(uuid, None)
+        self.compact_clients.discard(uuid)
+        self.release_client_key(uuid)
+        self.sessions.remove_active(uuid)
+        self.leave_group(uuid)
+
+    def release_client_key(self, uuid):
+        fingerprint = self.client_key_fingerprints.pop(uuid, None)
+        if fingerprint is not None:
+            cipher_cache.release(fingerprint)
 
     def client_ringACK_associate_with_address(self, msg):
         logger.info('Client %s responded to ring ID%d', msg['UUID'], msg['ID'])
-        #self.ring_queue['lock'].acquire_lock()
-        ring_queue_len = len(self.ring_queue['list'])
-        #self.ring_queue['lock'].release_lock()
-        for x in range(0, ring_queue_len):
-            #self.ring_queue['lock'].acquire_lock()
-            if self.ring_queue['list'][x]['ID'] == msg['ID']:
-                ring_item = self.ring_queue['list'].pop(x)
-                ring_item['timeout_handle'].disable()
-                self.address_client_list.append({'UUID': msg['UUID'], 'address': ring_item['address'],
-                                                 'service': ring_item['service']})
-                out_msg = json.dumps({'type': 'ringACKACK', 'ID': msg['ID'], 'UUID': msg['UUID']})
-                self.send_to_all_clients(out_msg)
-                if ring_item['service'] in self.modules_without_chat_states:
-                    state = 'no_state'
-                    out_msg = json.dumps({'type': 'chat_state', 'UUID': msg['UUID'], 'I/O': 'in', 'state': state})
-                    self.encrypt_and_send(out_msg, msg['UUID'])
-                for text in ring_item['text']:
-                    out_msg = json.dumps({'type': 'msg', 'msg': [text], 'I/O': 'in', 'UUID': msg['UUID']})
-                    self.encrypt_and_send(out_msg, msg['UUID'])
-                #self.ring_queue['lock'].release_lock()
-                logger.debug('client_ringACK_associate_with_address return')
-                return
-        #self.ring_queue['lock'].release_lock()
-        return  # no matches found
+        if self.rings.get(msg['ID']) is None:
+            return  # Answered by another client or timed out
+        if not self.sessions.has_capacity(msg['UUID']):
+            logger.info('Client %s is full, ringACK ignored', msg['UUID'])
+            return
+        ring = self.rings.pop(msg['ID'])
+        self.sessions.associate(msg['UUID'], ring.address, ring.service, msg['ID'])
+        out_msg = json.dumps({'type': 'ringACKACK', 'ID': msg['ID'], 'UUID': msg['UUID']})
+        self.send_to_clients(out_msg, ring.rung | {msg['UUID']})  # Only they saw the ring
+        if ring.service in self.modules_without_chat_states:
+            state = 'no_state'
+            out_msg = json.dumps({'type': 'chat_state', 'UUID': msg['UUID'], 'I/O': 'in', 'state': state,
+                                  'ID': msg['ID']})
+            self.encrypt_and_send(out_msg, msg['UUID'])
+        self.send_texts_to_client(msg['UUID'], ring.text, msg['ID'])
 
     def send_full_autoreply(self, msg, service):
         logger.info('User turned away due to all clients being busy')
         user_address = msg[1]
-        if service == 'Facebook':
-            self.fb_queue_out.put((user_address, self.options['messages']['no_clients_available'], 'active'))
-
-    def uuid_to_address_service(self, uuid) -> str:
-        for x in range(0, len(self.address_client_list)):
-            if self.address_client_list[x]['UUID'] == uuid:
-                return self.address_client_list[x]['address'], self.address_client_list[x]['service']
-        return None
+        self.outgoing_dispatch((service, user_address, self.options['messages']['no_clients_available'], 'active'))
+
+    def wait_for_client(self, msg, service):
+        """Queues a new user in the waiting room, or turns them away when it is full"""
+        timeout = self.timers.schedule(self.waiting_room.max_wait, "waiting_timed_out", str(msg[1]))
+        if not self.waiting_room.join(msg[1], service, msg[2], timeout):
+            timeout.cancel()
+            self.send_full_autoreply(msg, service)
+            return
+        logger.info('User waiting for a client, %d in the waiting room', len(self.waiting_room))
+        self.send_waiting_position(service, msg[1], len(self.waiting_room))
+        if self.waiting_update_handle is None:
+            self.waiting_update_handle = self.timers.schedule(self.waiting_update_interval,
+                                                              "waiting_room_update", None)
+
+    def send_waiting_position(self, service, address, position):
+        text = self.options['messages'].get('waiting', 'All representatives are busy, you are number {position} '
+                                                       'in the queue.')
+        self.outgoing_dispatch((service, address, text.format(position=position), 'active'))
+
+    def waiting_room_update(self, arg):
+        self.waiting_update_handle = None
+        for address, service, position in self.waiting_room.moved_up():
+            self.send_waiting_position(service, address, position)
+        if len(self.waiting_room):
+            self.waiting_update_handle = self.timers.schedule(self.waiting_update_interval,
+                                                              "waiting_room_update", None)
+
+    def waiting_timed_out(self, address):
+        entry = self.waiting_room.remove(address)
+        if entry is not None:
+            logger.info('User waited %ds without a client', self.waiting_room.max_wait)
+            self.send_full_autoreply((entry['service'], address), entry['service'])
+
+    def admit_waiting(self):
+        """Rings for waiting users, front first, while the ready clients have room the current rings don't claim"""
+        while len(self.waiting_room) and len(self.rings) < self.sessions.spare_capacity():
+            address, entry = self.waiting_room.pop_next()
+            entry['timeout_handle'].cancel()
+            self.outgoing_dispatch((entry['service'], address, self.options['messages']['ringing'], 'active'))
+            self.start_ring(address, entry['service'], entry['text'])
+
+    def uuid_to_address_service(self, uuid, conversation=None) -> tuple:
+        association = self.sessions.find_uuid(uuid, conversation)
+        if association is None:
+            return None
+        return association.address, association.service
 
     def inter_com_dispatch(self, msg):
+        if isinstance(msg, bytes):
+            self.decrypt_compact(msg)
+            return
         if msg['to'] != 'alice':
             logger.debug('Message bounced back')
             return
-        msg = self.decrypt_reconstruct(msg)
-        if not msg:
+        self.decrypt_reconstruct(msg)
+
+    def classify_inter_com(self, msg):
+        if isinstance(msg, tuple):  # (connection, state) from an inter_com connection's ReconnectSupervisor
+            self.update_connection_status(msg)
+            return
+        if isinstance(msg, dict) and 'to' not in msg:  # Unencrypted presence or ping event
+            self.liveness_event(msg)
+            return
+        # Control envelopes only skip ahead of other clients' traffic, never their own client's.
+        try:
+            if isinstance(msg, bytes):
+                flags, uuid = peek(msg)
+                control = bool(flags & FLAG_CONTROL)
+            else:
+                uuid, control = msg['UUID'], msg.get('hint') == 'control'
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError):
             logger.info('inter_com invalid message received')
             return
+        if control and not self.bulk_pending.get(uuid):
+            self.inter_com_control.append(msg)
+        else:
+            self.inter_com_bulk.append((uuid, msg))
+            self.bulk_pending[uuid] = self.bulk_pending.get(uuid, 0) + 1
+
+    def process_inter_com(self):
+        """Handles every waiting control envelope then up to batch_size others, returns True if any are left"""
+        while self.inter_com_control:
+            self.inter_com_dispatch(self.inter_com_control.popleft())
+        for _ in range(min(self.batch_size, len(self.inter_com_bulk))):
+            uuid, msg = self.inter_com_bulk.popleft()
+            self.bulk_pending[uuid] -= 1
+            if not self.bulk_pending[uuid]:
+                self.bulk_pending.pop(uuid)
+            self.inter_com_dispatch(msg)
+        return bool(self.inter_com_bulk)
+
+    def client_dispatch(self, msg):
+        if not msg:
+            logger.info('inter_com invalid message received')  # TODO add proper logger warning
+            return
 
         if msg['type'] == 'probeACK':
             self.update_active_client_timers(msg['UUID'])
@@ -308,8 +641,15 @@ class Dispatch(Thread):
         if msg['type'] == 'msg':
             if msg['I/O'] == 'out':
                 self.update_active_client_timers(msg['UUID'])
-                address, service = self.uuid_to_address_service(msg['UUID'])
-                self.outgoing_dispatch((service, address, msg['msg'], 'active'))
+                address_service = self.uuid_to_address_service(msg['UUID'], msg.get('ID'))
+                if address_service is None:
+                    logger.info('Message from unassociated client: %s', msg['UUID'])
+                    return
+                address, service = address_service
+                self.outgoing_dispatch((service, address, msg['msg'], 'active', 'message'))
+        elif msg['type'] == 'chat_state':
+            if msg['I/O'] == 'out':
+                self.client_chat_state(msg)
         elif msg['type'] == 'ringACK':
             self.update_active_client_timers(msg['UUID'])
             self.client_ringACK_associate_with_address(msg)
@@ -319,7 +659,7 @@ class Dispatch(Thread):
             self.send_status_to_clients()
         elif msg['type'] == 'disassociate':
             self.update_active_client_timers(msg['UUID'])
-            self.client_disassociate_with_address(msg['UUID'])
+            self.client_disassociate_with_address(msg['UUID'], msg.get('ID'))
         elif msg['type'] == 'disconnect':
             self.client_disconnect(msg['UUID'])
         else:
@@ -333,43 +673,46 @@ class Dispatch(Thread):
         self.add_to_active_clients(uuid)
 
     def add_to_active_clients(self, uuid):
-        self.active_clients['lock'].acquire_lock()
-        if uuid not in self.active_clients['list']:
-            self.active_clients['list'].append(uuid)
-        self.active_clients['lock'].release_lock()
+        self.sessions.add_active(uuid)
+        self.admit_waiting()
 
     def incoming_chat_state(self, msg):
-        uuid = False
-        for x in range(0, len(self.address_client_list)):  # incoming to clients
-                if self.address_client_list[x]['address'] == msg['address']:
-                    uuid = self.address_client_list[x]['UUID']
-                    break
-        if not uuid:
+        if self.sessions.find_address(msg['address']) is None:
             return
-        self.outgoing_chat_state(msg, uuid)
-        
-    def outgoing_chat_state(self, msg, uuid):
+        self.chat_states.push(msg['address'], msg['state'])
+
+    def flush_due_chat_states(self):
+        """Sends debounced chat states that are due, returns seconds until the next one is"""
+        ready, next_due = self.chat_states.pop_due()
+        for address, state in ready:
+            association = self.sessions.find_address(address)
+            if association is not None:
+                self.outgoing_chat_state({'state': state}, association.UUID, association.ID)
+        return next_due
+
+    def client_chat_state(self, msg):
+        # The client's typing state, passed on to the user as a bodiless chat state stanza.
+        address_service = self.uuid_to_address_service(msg['UUID'], msg.get('ID'))
+        if address_service is None:
+            return
+        address, service = address_service
+        if service in self.modules_without_chat_states:
+            return
+        state = {'typing': 'composing', 'idle': 'active'}.get(msg['state'], msg['state'])
+        if state in ('active', 'composing', 'paused', 'inactive', 'gone'):
+            self.outgoing_dispatch((service, address, '', state, 'chat_state'))
+
+    def outgoing_chat_state(self, msg, uuid, conversation=None):
         state = msg['state']
         if state == 'active':
             state = 'idle'
         elif state == 'composing':
             state = 'typing'
-        msg = json.dumps({'type': 'chat_state', 'UUID': uuid, 'I/O': 'in', 'state': state})
+        msg = json.dumps({'type': 'chat_state', 'UUID': uuid, 'I/O': 'in', 'state': state, 'ID': conversation})
         self.encrypt_and_send(msg, uuid)
 
     def are_all_clients_full(self):
-        matches = 0
-        self.active_clients['lock'].acquire_lock()
-        for x in range(0, len(self.active_clients['list'])):
-            for y in range(0, len(self.address_client_list)):
-                if self.active_clients['list'][x] == self.address_client_list[y]['UUID']:
-                    matches += 1
-        if matches < len(self.active_clients['list']):
-            self.active_clients['lock'].release_lock()
-            return False
-        else:
-            self.active_clients['lock'].release_lock()
-            return True
+        return self.sessions.all_clients_full()
 
     def filter_incoming_msg(self, service, msg):
         """A filter func for services that have identifiable info or buggy implementations"""
@@ -387,12 +730,20 @@ class Dispatch(Thread):
     def incoming_dispatch(self, msg, service):
         if type(msg) == dict:
             if msg['type'] == 'chat_state':
+                self.service_queues[service].note(msg['address'], msg.get('account'))
+                if self.is_overloaded():
+                    count_rejected(self.messages_rejected)
+                    return
                 self.incoming_chat_state(msg)
-                return
-        # A chat message = ('msg', from, text)
+            elif msg['type'] == 'outbound_metrics':
+                self.outbound_metrics[msg.get('account', service)] = msg['lanes']
+            return
+        # A chat message = ('msg', from, text, account)
         if len(msg) == 2:  # Status message
             self.update_status(msg)
             return
+        if len(msg) > 3:  # Replies to this user go out through the account they wrote to
+            self.service_queues[service].note(msg[1], msg[3])
         logger.debug('Message received from internet')
         if msg[0] == 'msg':
             # got an incoming message
@@ -413,64 +764,233 @@ class Dispatch(Thread):
                 logger.info('Admin debug command %s', msg[2])
                 self.outgoing_dispatch((service, msg[1], self.admin_debug_interface.request(msg[2]), 'active'))
                 return
-            address = msg[1]
-            found = False
-            for x in range(0, len(self.address_client_list)):  # incoming to clients
-                if self.address_client_list[x]['address'] == address:
-                    uuid = self.address_client_list[x]['UUID']
-                    logger.debug('Found match for '+hex(hash(msg[1]))+' from '+service+' to UUID:'+uuid)
-                    found = True
-                    filtered_msg = self.filter_incoming_msg(service, msg[2])
-                    if uuid in self.grace_clients:
-                        self.grace_clients[uuid]['msg_cache'].append(filtered_msg)
-                    msg = json.dumps({'type': 'msg', 'msg': [filtered_msg], 'I/O': 'in', 'UUID': uuid})
-                    self.encrypt_and_send(msg, uuid)
-                    break
-            if not found:
-                if self.are_all_clients_full():  # Send reply
+            association = self.sessions.find_address(msg[1])
+            if association is not None:  # incoming to clients
+                uuid = association.UUID
+                logger.debug('Found match for '+hex(hash(msg[1]))+' from '+service+' to UUID:'+uuid)
+                filtered_msg = self.filter_incoming_msg(service, msg[2])
+                if uuid in self.grace_clients:
+                    self.grace_clients[uuid]['msg_cache'].append((association.ID, filtered_msg))
+                self.send_texts_to_client(uuid, [filtered_msg], association.ID)
+            elif msg[1] in self.waiting_room:
+                self.waiting_room.add_text(msg[1], msg[2])
+            elif self.rings.find_address(msg[1]) is not None:
+                self.send_ring_to_clients(msg, service)  # Added to the user's ring
+            else:
+                if self.is_overloaded():  # Turn new users away before they add rings to the backlog
+                    count_rejected(self.messages_rejected)
                     self.send_full_autoreply(msg, service)
+                elif self.are_all_clients_full() or len(self.waiting_room):  # Behind anyone already waiting
+                    self.wait_for_client(msg, service)
                 else:
                     self.outgoing_dispatch((service, msg[1], self.options['messages']['ringing'], 'active'))
                     self.send_ring_to_clients(msg, service)
 
+    def inbound_depths(self):
+        depths = {'inter_com': queue_depth(self.inter_com_queue_in), 'inter_com_backlog': len(self.inter_com_bulk)}
+        for service, service_queue in self.service_queues.items():
+            depths[service] = queue_depth(service_queue.incoming_queue)
+        return depths
+
+    def is_overloaded(self):
+        return max(self.inbound_depths().values()) >= self.high_water
+
+    def load_stats(self):
+        return {'messages_rejected': self.messages_rejected.value, 'high_water': self.high_water,
+                'inbound_depths': self.inbound_depths(), 'client_load': self.sessions.load_stats(),
+                'waiting_room': self.waiting_room.stats()}
+
     def outgoing_dispatch(self, msg):
+        # (service, address, text, state[, lane]) lane is an outbound_scheduler lane, auto replies by default.
         logger.debug('Message being sent to internet')
-        service, user_address, msg, state = msg
-        if service == 'Facebook':
-            self.fb_queue_out.put((user_address, msg, state))
-        elif service == 'Zoho':
-            self.zoho_queue_out.put((user_address, msg, state))
-        else:
-            pass
+        service, user_address, text, state = msg[:4]
+        lane = msg[4] if len(msg) > 4 else 'auto_reply'
+        if service in self.service_queues:
+            self.service_queues[service].put(user_address, (user_address, text, state, lane))
+
+    def snapshot_state(self):
+        """Everything needed to carry on after a restart, as JSON types. Timers are saved as seconds left."""
+        now = time.time()
+
+        def seconds_left(handle):
+            return max(0, handle.deadline - now) if handle is not None and handle.is_pending() else None
+
+        sessions = self.sessions.snapshot()
+        for association in sessions['associations']:
+            association['address'] = str(association['address'])
+        rings = []
+        for ring in self.rings.rings():
+            item = ring.to_dict()
+            item['address'] = str(item['address'])
+            item['remaining'] = seconds_left(ring.timeout_handle)
+            rings.append(item)
+        self.clients['lock'].acquire_lock()
+        clients = [uuid for uuid, timers in self.clients['dict'].items()
+                   if timers['timeout'].is_pending() and uuid not in self.grace_clients]
+        self.clients['lock'].release_lock()
+        state = {'ring_counter': self.ring_counter, 'sessions': sessions, 'rings': rings, 'clients': clients,
+                 'grace_clients': {uuid: {'msg_cache': grace['msg_cache'],
+                                          'remaining': seconds_left(grace['timeout_handle'])}
+                                   for uuid, grace in self.grace_clients.items()},
+                 'waiting_room': [{'address': address, 'service': entry['service'], 'text': entry['text'],
+                                   'waited': time.monotonic() - entry['joined'],
+                                   'remaining': seconds_left(entry['timeout_handle'])}
+                                  for address, entry in self.waiting_room.waiting.items()],
+                 'pending_texts': {uuid: list(pending['msg'].items()) for uuid, pending in self.pending_texts.items()},
+                 'admin': {'service': self.admin['service'], 'address': str(self.admin['address'])}}
+        if self.snapshot_keys:  # Otherwise every client repeats the key handshake after a restart
+            state.update({'client_keys': self.client_keys,
+                          'client_sessions': {uuid: session.key_b64()
+                                              for uuid, session in self.client_sessions.items()},
+                          'group_capable': list(self.group_capable), 'compact_clients': list(self.compact_clients)})
+        return state
+
+    def restore_state(self, state):
+        """Loads a snapshot_state() into a Dispatch that has not handled anything yet and re-arms its timers.
+
+        The whole snapshot is read into new structures first, so a bad one raises before anything is changed.
+        """
+        restored = self.read_state(state)
+        self.ring_counter = restored['ring_counter']
+        for uuid, key in restored['client_keys'].items():
+            self.pin_client_key(uuid, key)
+        self.client_sessions.update(restored['client_sessions'])
+        self.group_capable.update(restored['group_capable'])  # The group key is not saved, a new one is sent
+        self.compact_clients.update(restored['compact_clients'])
+        for uuid, groups, capacity in restored['active']:
+            self.sessions.set_groups(uuid, groups)
+            self.sessions.set_capacity(uuid, capacity)
+            self.sessions.add_active(uuid)
+        for uuid, address, service, conversation in restored['associations']:
+            self.sessions.associate(uuid, address, service, conversation)
+        # Clients get the usual probe and timeout, those that didn't survive the restart time out as normal.
+        # Without saved keys that includes every client that doesn't repeat the key handshake in time.
+        for uuid in restored['clients']:
+            self.update_active_client_timers(uuid)
+        for uuid, (msg_cache, remaining) in restored['grace_clients'].items():
+            self.update_active_client_timers(uuid)
+            self.client_timed_out(uuid)
+            self.grace_clients[uuid]['msg_cache'] = msg_cache
+            self.grace_clients[uuid]['timeout_handle'].reschedule(remaining)
+        for ring, remaining in restored['rings']:
+            ring.timeout_handle = self.timers.schedule(remaining, "ring_timed_out", ring.ID)
+            ring.widen_handle = self.timers.schedule(self.ring_router.widen_after, "ring_widen", ring.ID)
+            self.rings.add(ring)
+        for address, service, texts, waited, remaining in restored['waiting_room']:
+            timeout = self.timers.schedule(remaining, "waiting_timed_out", address)
+            self.waiting_room.join(address, service, texts[0], timeout, waited)
+            for text in texts[1:]:
+                self.waiting_room.add_text(address, text)
+        if len(self.waiting_room):
+            self.waiting_update_handle = self.timers.schedule(self.waiting_update_interval,
+                                                              "waiting_room_update", None)
+        for uuid, conversations in restored['pending_texts'].items():
+            for conversation, texts in conversations:
+                self.send_texts_to_client(uuid, texts, conversation)
+        self.admin.update(restored['admin'])
+        logger.info('Restored %d conversations, %d rings and %d clients from the snapshot',
+                    len(restored['associations']), len(restored['rings']),
+                    len(restored['clients']) + len(restored['grace_clients']))
+        self.admit_waiting()
+
+    def read_state(self, state):
+        """The parts of a snapshot_state() as restore_state uses them, raises on anything missing or malformed"""
+        elapsed = time.time() - state['saved']
+
+        def seconds_left(remaining, default):
+            return default if remaining is None else max(1, remaining - elapsed)
+
+        sessions = state['sessions']
+        rings = []
+        for item in state['rings']:
+            ring = Ring(item['ID'], item['address'], item['service'], item['group'], item['expires'], item['text'])
+            ring.rung.update(item['rung'])
+            ring.wave = item['wave']
+            rings.append((ring, seconds_left(item['remaining'], 60)))
+        waiting_room = []
+        for item in state['waiting_room']:
+            if not item['text']:
+                raise ValueError('Waiting user without text')
+            waiting_room.append((item['address'], item['service'], list(item['text']), item['waited'],
+                                 seconds_left(item['remaining'], self.waiting_room.max_wait)))
+        return {'ring_counter': int(state['ring_counter']),
+                'client_keys': dict(state.get('client_keys', {})),  # Only saved with snapshot_keys = 1
+                'client_sessions': {uuid: SessionCipher(base64.standard_b64decode(key))
+                                    for uuid, key in state.get('client_sessions', {}).items()},
+                'group_capable': set(state.get('group_capable', [])),
+                'compact_clients': set(state.get('compact_clients', [])),
+                'active': [(uuid, sessions['groups'].get(uuid, []), sessions['capacity'].get(uuid, 1))
+                           for uuid in sessions['active']],
+                'associations': [(association['UUID'], association['address'], association['service'],
+                                  association['ID']) for association in sessions['associations']],
+                'clients': list(state['clients']),
+                'grace_clients': {uuid: ([tuple(cached) for cached in grace['msg_cache']],
+                                         seconds_left(grace['remaining'], 60))
+                                  for uuid, grace in state['grace_clients'].items()},
+                'rings': rings, 'waiting_room': waiting_room,
+                'pending_texts': {uuid: [(conversation, list(texts)) for conversation, texts in conversations]
+                                  for uuid, conversations in state['pending_texts'].items()},
+                'admin': {'service': state['admin']['service'], 'address': state['admin']['address']}}
+
+    def take_snapshot(self, arg=None):
+        try:
+            size = save_snapshot(self.snapshot_path, self.snapshot_state())
+            logger.debug('Dispatch snapshot saved, %d bytes', size)
+        except Exception:  # A failed snapshot must never stop the dispatch loop
+            logger.error('Dispatch snapshot failed', exc_info=True)
+        if arg == 'periodic' and not self.kill_event.is_set():
+            self.timers.schedule(self.snapshot_interval, "take_snapshot", 'periodic')
+
+    def restore_snapshot(self):
+        state = load_snapshot(self.snapshot_path, self.snapshot_max_age)
+        if state is None:
+            return
+        try:
+            self.restore_state(state)
+        except Exception:  # A malformed snapshot fails in read_state, before anything is restored
+            logger.error('Dispatch snapshot could not be restored', exc_info=True)
+
+    def drain_queue(self, source_queue, handler, limit=None):
+        """Handles up to limit (default batch_size) messages already waiting on source_queue"""
+        for _ in range(limit or self.batch_size):
+            try:
+                item = source_queue.get_nowait()
+            except queue.Empty:
+                return
+            handler(item)
 
     def run(self):
+        # [(queue, handler[, limit]), ...] Every inbound source that can wake the dispatch thread.
+        # Sorting inter_com envelopes is cheap, so read further ahead to find control messages.
+        inbound_sources = [(self.inter_com_queue_in, self.classify_inter_com, self.batch_size*10),
+                           (self.time_event_queue, self.time_event_handler),
+                           (self.crypto.ready_queue, self.crypto.complete)]
+        for service, service_queue in self.service_queues.items():
+            inbound_sources.append((service_queue.incoming_queue,
+                                    functools.partial(self.incoming_dispatch, service=service)))
+        # multiprocessing.Queue has no public select(), but its pipe reader works with connection.wait().
+        readers = {source[0]._reader: source for source in inbound_sources}
+        inter_com_reader = self.inter_com_queue_in._reader
+        self.timers.start()
+        if self.snapshot_interval:
+            self.restore_snapshot()
+            self.timers.schedule(self.snapshot_interval, "take_snapshot", 'periodic')
+        wait_time = 0.5
         while True:
-            try:
-                inter_com_in = self.inter_com_queue_in.get(timeout=0.1)
-            except:  # TODO Narrow exception
-                inter_com_in = False
-            if inter_com_in:
-                self.inter_com_dispatch(inter_com_in)
-            try:
-                fb_in = self.fb_queue_in.get(timeout=0.1)
-            except:  # TODO Narrow exception
-                fb_in = False
-            if fb_in:
-                self.incoming_dispatch(fb_in, 'Facebook')
-            try:
-                zoho_in = self.zoho_queue_in.get(timeout=0.1)
-            except:  # TODO Narrow exception
-                zoho_in = False
-            if zoho_in:
-                self.incoming_dispatch(zoho_in, 'Zoho')
-            try:
-                time_event = self.time_event_queue.get(timeout=0.1)
-            except:  # TODO Narrow exception
-                time_event = False
-            if time_event:
-                self.time_event_handler(time_event)
+            # Sleep until any queue has data, then drain every ready queue in one pass.
+            for reader in multiprocessing.connection.wait(list(readers), timeout=wait_time):
+                if reader is inter_com_reader and len(self.inter_com_bulk) >= self.high_water:
+                    continue  # Leave the rest in the bounded queue until the backlog shrinks
+                self.drain_queue(*readers[reader])
+            backlog = self.process_inter_com()
+            next_flushes = [wait for wait in (self.flush_due_texts(), self.flush_due_chat_states()) if wait is not None]
+            wait_time = 0 if backlog else min([0.5] + next_flushes)
 
             if self.kill_event.is_set():
+                if self.snapshot_interval:
+                    self.take_snapshot()
+                self.timers.stop()
+                self.crypto.shutdown()
                 logger.info('Thread ending :%s', 'Dispatch')
                 break
-        return
\ No newline at end of file
+        return
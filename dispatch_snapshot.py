@@ -0,0 +1,63 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Dispatch writes its conversations, rings, grace clients and optionally client keys to a local file every
+# snapshot_interval seconds and when it stops, and reads them back when it starts. A restart then keeps
+# every conversation, and with snapshot_keys = 1 clients don't have to repeat the RSA handshake either.
+# The file holds user addresses and texts, and then session keys in plain text, so it is only readable by the
+# server's user.
+
+import json
+import os
+import time
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1  # Bumped whenever the layout of the state changes, other versions are ignored
+
+
+def save_snapshot(path, state):
+    """Writes state as zlib compressed JSON, replacing the previous snapshot atomically"""
+    data = zlib.compress(bytes(json.dumps(dict(state, version=SNAPSHOT_VERSION, saved=time.time())),
+                               encoding='utf'))
+    temp_path = path+'.tmp'
+    try:
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            if hasattr(os, 'fchmod'):  # Not on Windows, where the os.open mode is all there is
+                os.fchmod(snapshot_file.fileno(), 0o600)  # In case a stale temp file had other permissions
+            snapshot_file.write(data)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+
+def load_snapshot(path, max_age=300):
+    """The saved state, or None when there is no usable snapshot no older than max_age seconds"""
+    try:
+        with open(path, 'rb') as snapshot_file:
+            state = json.loads(zlib.decompress(snapshot_file.read()).decode('utf'))
+    except FileNotFoundError:
+        return None
+    except (OSError, zlib.error, ValueError):
+        logger.warning('Unreadable dispatch snapshot %s ignored', path, exc_info=True)
+        return None
+    if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+        logger.warning('Dispatch snapshot %s has an unknown version, ignored', path)
+        return None
+    age = time.time() - state.get('saved', 0)
+    if not 0 <= age <= max_age:
+        logger.info('Dispatch snapshot %s is %ds old, ignored', path, age)
+        return None
+    return state
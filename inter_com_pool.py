@@ -0,0 +1,176 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Several inter_com XMPP streams share the client traffic. Every connection puts what it receives on the
+# same incoming queue, so Dispatch never knows how many there are. Outgoing messages are routed to a
+# connection by consistent hashing of the client's UUID, skipping connections that are down.
+# Messages clients send to the bare JID all reach the highest priority resource, so with several connections
+# each client is told, in an unencrypted 'route' message, the full JID of the connection it is assigned to.
+# Clients that send to that JID spread the inbound traffic too, clients that ignore it still work.
+
+import bisect
+import hashlib
+import json
+import multiprocessing
+import queue
+from collections import deque
+from threading import Thread
+from inter_com_xmpp import InterComXMPP, SERVER_RESOURCE
+from reconnect import make_reconnect_supervisor, ONLINE
+import logging
+logger = logging.getLogger(__name__)
+
+DOWN = 0
+UP = 1
+
+
+def ring_hash(key):
+    return int(hashlib.md5(bytes(key, encoding='utf')).hexdigest()[:16], 16)
+
+
+class ConsistentHashRing(object):
+    def __init__(self, names, replicas=64):
+        self.points = sorted((ring_hash('%s#%d' % (name, x)), name) for name in names for x in range(replicas))
+        self.hashes = [point[0] for point in self.points]
+
+    def lookup(self, key, is_healthy=lambda name: True):
+        """Returns the first healthy name clockwise from key, or the first name if none are healthy"""
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for x in range(len(self.points)):
+            name = self.points[(start + x) % len(self.points)][1]
+            if is_healthy(name):
+                return name
+        return self.points[start % len(self.points)][1]
+
+
+class InterComConnection(Thread):
+    """One inter_com XMPP stream with its own outgoing queue of (msg, uuid), msg None pings the client"""
+    def __init__(self, kill_event, name, jid, password, incoming_queue, reply_to, priority=0,
+                 outgoing_queue=None, health=None, sent=None, dropped=None, options=None):
+        super().__init__()
+        self.kill_event = kill_event
+        self.name = name
+        self.jid = jid
+        self.password = password
+        self.incoming_queue = incoming_queue
+        self.outgoing_queue = multiprocessing.Queue() if outgoing_queue is None else outgoing_queue
+        self.reply_to = reply_to  # The account clients log in to, messages go to reply_to/uuid
+        self.priority = priority
+        self.health = multiprocessing.Value('i', DOWN) if health is None else health
+        self.sent = multiprocessing.Value('i', 0) if sent is None else sent
+        self.dropped = multiprocessing.Value('i', 0) if dropped is None else dropped  # Reconnect buffer overflow
+        self.options = options or {}
+
+    def spec(self):
+        """(class, kwargs) to build this connection again in a child process, see connector_process"""
+        return InterComConnection, {'kill_event': self.kill_event, 'name': self.name, 'jid': self.jid,
+                                    'password': self.password, 'incoming_queue': self.incoming_queue,
+                                    'reply_to': self.reply_to, 'priority': self.priority,
+                                    'outgoing_queue': self.outgoing_queue, 'health': self.health, 'sent': self.sent,
+                                    'dropped': self.dropped, 'options': self.options}
+
+    def report(self, state):
+        """Connection state changes go to Dispatch.update_connection_status as (name, state)"""
+        self.health.value = UP if state == ONLINE else DOWN
+        self.incoming_queue.put((self.name, state))
+
+    def run(self):
+        supervisor = make_reconnect_supervisor(
+            self.options, self.name,
+            lambda callback: InterComXMPP(self.jid, self.password, self.incoming_queue, callback, self.priority,
+                                          self.reply_to),
+            lambda inter_com: inter_com.connect(reattempt=False), self.report)
+        # Held while the connection is down, the oldest are dropped past buffer_size and counted in dropped.
+        buffered = deque()
+        buffer_size = int(self.options.get('reconnect_buffer_size', 1000))
+        dropped = 0  # Since the connection was last online
+        while True:  # main thread loop
+            supervisor.poll()
+            try:
+                buffered.append(self.outgoing_queue.get(timeout=0.1))
+                while True:
+                    buffered.append(self.outgoing_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if buffered and supervisor.is_online():
+                batch = list(buffered)
+                buffered.clear()
+                supervisor.client.send_batch(batch, self.reply_to)
+                self.sent.value += len(batch)
+                if dropped:
+                    logger.warning('%s back online, %d client messages were dropped while it was down',
+                                   self.name, dropped)
+                    dropped = 0
+            elif len(buffered) > buffer_size:
+                if not dropped:
+                    logger.warning('%s reconnect buffer full, dropping the oldest client messages', self.name)
+                overflow = len(buffered) - buffer_size
+                for _ in range(overflow):
+                    buffered.popleft()
+                dropped += overflow
+                self.dropped.value += overflow
+            if self.kill_event.is_set():
+                supervisor.stop()
+                logger.info('Thread ending: %s', self.name)
+                break
+        return
+
+
+def inter_com_accounts(options):
+    """Returns [(name, username, password), ...] for 'inter_com' and any 'inter_com <n>' accounts"""
+    accounts = []
+    for name in sorted(options['accounts']):
+        if name == 'inter_com' or name.startswith('inter_com '):
+            account = options['accounts'][name]
+            accounts.append((name, account['username'], account['password']))
+    return accounts
+
+
+class InterComPool(object):
+    """The inter_com connections configured in settings.ini, see inter_com_accounts and 'inter_com_connections'"""
+    def __init__(self, kill_event, incoming_queue, options):
+        self.reply_to = options['accounts']['inter_com']['username']
+        resources = int(options.get('inter_com_connections', 1))
+        self.connections = {}  # {name: InterComConnection, ...}
+        for name, username, password in inter_com_accounts(options):
+            for x in range(resources):
+                jid = username
+                if resources > 1:
+                    jid = username+'/'+SERVER_RESOURCE+str(x)
+                connection_name = name if resources == 1 else name+'/'+str(x)
+                # Descending priorities so a bare JID message is only delivered to one server resource.
+                priority = len(self.connections) * -1 + 127
+                self.connections[connection_name] = InterComConnection(kill_event, connection_name, jid, password,
+                                                                       incoming_queue, self.reply_to, priority,
+                                                                       options=options)
+        self.ring = ConsistentHashRing(list(self.connections))
+        self.announced = {}  # {uuid: name of the connection the client was last told to send to, ...}
+        self.max_announced = 10000
+
+    def is_healthy(self, name):
+        return self.connections[name].health.value == UP
+
+    def route(self, uuid):
+        return self.connections[self.ring.lookup(uuid, self.is_healthy)]
+
+    def send(self, msg, uuid):
+        connection = self.route(uuid)
+        if len(self.connections) > 1 and self.announced.get(uuid) != connection.name:
+            self.announce(connection, uuid)
+        connection.outgoing_queue.put((msg, uuid))
+
+    def announce(self, connection, uuid):
+        """Tells the client which connection to send to, again whenever a connection going down moves it"""
+        if len(self.announced) >= self.max_announced:
+            self.announced.clear()
+        self.announced[uuid] = connection.name
+        route = json.dumps({'type': 'route', 'UUID': uuid, 'server': connection.jid})
+        connection.outgoing_queue.put((route, uuid))
+
+    def health(self):
+        return {name: {'up': connection.health.value == UP, 'sent': connection.sent.value,
+                       'dropped': connection.dropped.value}
+                for name, connection in self.connections.items()}
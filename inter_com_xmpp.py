@@ -9,20 +9,38 @@
 
 import sleekxmpp
 import json
+from compact_envelope import is_compact_body, decode_body
+from stanza_templates import MessageTemplate, JIDCache
 import logging
 logger = logging.getLogger(__name__)
 
+SERVER_RESOURCE = 'server'  # Pooled connections on the clients' account bind SERVER_RESOURCE+'0', '1'...
+
+
+def is_server_resource(resource):
+    """True for the resources of this server's own connections, see InterComPool"""
+    return resource.startswith(SERVER_RESOURCE) and resource[len(SERVER_RESOURCE):].isdigit()
+
 
 class InterComXMPP(sleekxmpp.ClientXMPP):
-    def __init__(self, jid, password, incoming_queue):
+    def __init__(self, jid, password, incoming_queue, status_callback, priority=0, client_account=None):
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
         self.jid = jid
         self.incoming_queue = incoming_queue
+        self.status_callback = status_callback  # ReconnectSupervisor.on_status, reconnecting is left to it
+        self.priority = priority
+        self.templates = MessageTemplate(self)
+        self.client_jids = JIDCache()  # Client JIDs 'username/uuid' by uuid
+        self.client_jids_username = None
+        self.client_account = client_account  # Clients log in as client_account/uuid, other presence is ignored
         self.add_event_handler("session_start", self.start)
+        self.add_event_handler("session_resumed", lambda stanza: self.status_report("session_resumed"))
         self.add_event_handler("message", self.process_message)
-        self.add_event_handler("session_end", lambda: self.status_report("session_end"))
-        self.add_event_handler("disconnected", lambda: self.status_report("disconnected"))
-        self.add_event_handler("connected", lambda: self.status_report("connected"))
+        self.add_event_handler("presence_available", lambda presence: self.process_presence(presence, True))
+        self.add_event_handler("presence_unavailable", lambda presence: self.process_presence(presence, False))
+        self.add_event_handler("session_end", lambda event: self.status_report("session_end"))
+        self.add_event_handler("disconnected", lambda event: self.status_report("disconnected"))
+        self.add_event_handler("connected", lambda event: self.status_report("connected"))
 
         self.register_plugin('xep_0030')  # Service Discovery
         self.register_plugin('xep_0004')  # Data Forms
@@ -31,8 +49,8 @@ class InterComXMPP(sleekxmpp.ClientXMPP):
         self.register_plugin('xep_0085')  # Chat State Notifications
         
     def start(self, event):
-        self.send_presence()
-        self.get_roster(block=True)
+        self.send_presence(ppriority=self.priority)
+        self.get_roster(block=False)  # Nothing waits on the roster, don't hold up the session for it
 
         # x = []
         # print(self.client_roster)
@@ -43,19 +61,62 @@ class InterComXMPP(sleekxmpp.ClientXMPP):
 
     
     def status_report(self, arg):
-        logger.info('intercom connection status changed: %s', arg)
-        if arg == 'disconnected' or arg == 'session_end':
-            if self.connect():
-                self.process()
+        logger.info('intercom connection status changed: %s %s', self.jid, arg)
+        self.status_callback(arg)
 
     def process_message(self, msg):
         logger.debug('inter_com from: %s', msg['from'])
         if msg['type'] in ('chat', 'normal'):
             try:
-                self.incoming_queue.put(json.loads(msg['body']))
+                body = msg['body']
+                if is_compact_body(body):  # Passed on as bytes, Dispatch parses them in place
+                    self.incoming_queue.put(decode_body(body))
+                else:
+                    envelope = json.loads(body)
+                    if 'to' not in envelope:  # Only this class puts liveness events, which have no 'to'
+                        raise ValueError('Envelope without to')
+                    self.incoming_queue.put(envelope)
             except:
                 logger.info('inter_com invalid message received')
 
+    def process_presence(self, presence, available):
+        """Client presence is put on incoming_queue as {'type': 'presence', 'UUID':-, 'available':-}"""
+        sender = presence['from']
+        if not sender.resource or sender == self.boundjid or is_server_resource(sender.resource):
+            return  # Not a client, the server's other connections share the clients' account
+        if self.client_account is not None and sender.bare != self.client_account:
+            return
+        self.incoming_queue.put({'type': 'presence', 'UUID': sender.resource, 'available': available})
+
+    def ping_client(self, username, uuid, timeout=10):
+        """XEP-0199 ping, the result is put on incoming_queue as {'type': 'ping', 'UUID':-, 'alive':-}"""
+        iq = self.Iq()
+        iq['type'] = 'get'
+        iq['to'] = self.client_jid(username, uuid)
+        iq.enable('ping')
+
+        def result(response):
+            # A client that doesn't support ping still answered, so it is alive.
+            alive = response['type'] == 'result' or response['error']['condition'] == 'feature-not-implemented'
+            self.incoming_queue.put({'type': 'ping', 'UUID': uuid, 'alive': alive})
+        iq.send(block=False, timeout=timeout, callback=result,
+                timeout_callback=lambda *args: self.incoming_queue.put({'type': 'ping', 'UUID': uuid, 'alive': False}))
+
+    def client_jid(self, username, uuid):
+        if username != self.client_jids_username:
+            self.client_jids, self.client_jids_username = JIDCache(username+'/'), username
+        return self.client_jids.get(uuid)
+
     def reply_message(self, text, username, uuid):
-        msg = self.make_message(mto=username+'/'+uuid, mbody=text, mtype='chat', mfrom=self.jid)
-        msg.send()
+        self.templates.build(self.client_jid(username, uuid), text).send()
+
+    def send_batch(self, items, username):
+        """Sends [(text, uuid), ...] to username/uuid in one pass, still one stanza each for stream management.
+
+        A text of None pings the client instead, see ping_client.
+        """
+        for text, uuid in items:
+            if text is None:
+                self.ping_client(username, uuid)
+            else:
+                self.templates.build(self.client_jid(username, uuid), text).send()
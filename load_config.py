@@ -22,7 +22,7 @@ class ConfigLoader(object):
             if section.split(' ')[0] == 'account':
                 try:
                     self.accounts.update({
-                        section.split(' ')[1]: {
+                        ' '.join(section.split(' ')[1:]): {  # '[account inter_com 2]' is 'inter_com 2'
                             'username': self.config.get(section, 'username'),
                             'password': self.config.get(section, 'password')
                         }
@@ -29,32 +29,33 @@ def setup_logging(default_path=r'resource\logging.json', default_level=logging.I
     else:
         logging.basicConfig(level=default_level)
 
-setup_logging()
-logger = logging.getLogger(__name__)
-logger.info('Server started')
-options = LoadConfig().get_options()
+if __name__ == '__main__':  # Child processes import this module too, see crypto_executor and connector_process
+    multiprocessing.freeze_support()
+    setup_logging()
+    logger = logging.getLogger(__name__)
+    logger.info('Server started')
+    options = LoadConfig().get_options()
 
-count = 0
-for proc in psutil.process_iter():
-    try:
-        if proc.name() == "NL_chat_server.exe":
-            count += 1
-            if count > 1:
-                logger.info('Server already running, exiting...')
-                input('A server is already running on this computer.\nPress enter key to exit.')
-                raise SystemExit
-    except psutil.AccessDenied:
-        pass
-#options['modules_without_chat_states'].append('zoho')
-incoming_queue = multiprocessing.Queue()  # Keeping these queues around in case a gui is needed.
-outgoing_queue = multiprocessing.Queue()
-root = ''
-multiprocessing.freeze_support()
-x = CommunicationThreadingManager(root, incoming_queue, outgoing_queue, options)
+    count = 0
+    for proc in psutil.process_iter():
+        try:
+            if proc.name() == "NL_chat_server.exe":
+                count += 1
+                if count > 1:
+                    logger.info('Server already running, exiting...')
+                    input('A server is already running on this computer.\nPress enter key to exit.')
+                    raise SystemExit
+        except psutil.AccessDenied:
+            pass
+    #options['modules_without_chat_states'].append('zoho')
+    incoming_queue = multiprocessing.Queue()  # Keeping these queues around in case a gui is needed.
+    outgoing_queue = multiprocessing.Queue()
+    root = ''
+    x = CommunicationThreadingManager(root, incoming_queue, outgoing_queue, options)
 
-while True:
-    if input('\nPress Q at any time to exit:\n') in ('q', 'Q'):
-        print('Exiting')
-        x.kill_all()
-        break
-raise SystemExit
\ No newline at end of file
+    while True:
+        if input('\nPress Q at any time to exit:\n') in ('q', 'Q'):
+            print('Exiting')
+            x.kill_all()
+            break
+    raise SystemExit
\ No newline at end of file
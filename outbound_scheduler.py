@@ -0,0 +1,123 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+from collections import deque
+import queue
+import time
+
+# Priority order, highest first.
+LANES = ('message', 'auto_reply', 'chat_state')
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate  # Tokens per second
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class OutboundScheduler(object):
+    """Paces a service connector's outgoing stanzas with a token bucket and priority lanes.
+
+    Items are [user_id, msg, state, queued_at]. A queued chat state is dropped when a newer chat state
+    or a message (which carries its own state) is queued for the same user.
+    """
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.lanes = {lane: deque() for lane in LANES}
+        self.chat_states = {}  # {str(user_id): item} The live chat state item per user
+        self.stats = {lane: {'sent': 0, 'superseded': 0, 'wait_total': 0.0, 'wait_max': 0.0} for lane in LANES}
+
+    def push(self, user_id, msg, state, lane='message'):
+        if lane not in self.lanes:
+            lane = 'message'
+        item = [user_id, msg, state, time.monotonic()]
+        stale = self.chat_states.pop(str(user_id), None)
+        if stale is not None:
+            stale[0] = None  # Left in its deque and skipped when it reaches the front
+            self.stats['chat_state']['superseded'] += 1
+        if lane == 'chat_state':
+            self.chat_states[str(user_id)] = item
+        self.lanes[lane].append(item)
+
+    def pop(self):
+        """Returns the next (user_id, msg, state) the rate allows, or None"""
+        now = time.monotonic()
+        for lane in LANES:
+            items = self.lanes[lane]
+            while items and items[0][0] is None:
+                items.popleft()
+            if items:
+                if not self.bucket.take(now):
+                    return None
+                user_id, msg, state, queued_at = items.popleft()
+                if lane == 'chat_state':
+                    self.chat_states.pop(str(user_id), None)
+                stats = self.stats[lane]
+                stats['sent'] += 1
+                stats['wait_total'] += now - queued_at
+                stats['wait_max'] = max(stats['wait_max'], now - queued_at)
+                return user_id, msg, state
+        return None
+
+    def wait_time(self):
+        """Seconds until pop() could return an item, None when nothing is queued"""
+        if not any(self.lanes.values()):
+            return None
+        return self.bucket.wait_time(time.monotonic())
+
+    def metrics(self):
+        lanes = {}
+        for lane in LANES:
+            stats = self.stats[lane]
+            lanes[lane] = {'depth': sum(1 for item in self.lanes[lane] if item[0] is not None),
+                           'sent': stats['sent'], 'superseded': stats['superseded'],
+                           'avg_wait': stats['wait_total'] / stats['sent'] if stats['sent'] else 0,
+                           'max_wait': stats['wait_max']}
+        return lanes
+
+
+def pump_outbound(outgoing_queue, scheduler, send_batch, timeout=0.1):
+    """Moves queued items from Dispatch into the scheduler, then sends as many as the rate allows.
+
+    send_batch gets every item released this pass as [(user_id, msg, state), ...]. With send_batch None
+    items are only held in the scheduler, e.g. while the connection is down.
+    """
+    wait = scheduler.wait_time() if send_batch is not None else None
+    try:
+        item = outgoing_queue.get(timeout=timeout if wait is None else min(timeout, wait))
+        while True:
+            scheduler.push(*item)
+            item = outgoing_queue.get_nowait()
+    except queue.Empty:
+        pass
+    if send_batch is None:
+        return
+    batch = []
+    while True:
+        item = scheduler.pop()
+        if item is None:
+            break
+        batch.append(item)
+    if batch:
+        send_batch(batch)
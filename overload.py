@@ -0,0 +1,64 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+import queue
+import logging
+logger = logging.getLogger(__name__)
+
+
+def queue_depth(source_queue):
+    try:
+        return source_queue.qsize()
+    except NotImplementedError:  # No sem_getvalue() on Mac OS X
+        return 0
+
+
+def count_rejected(rejected, count=1):
+    with rejected.get_lock():
+        rejected.value += count
+
+
+class InboundGate(object):
+    """Stands in for a bounded inbound queue on the producer side.
+
+    Above high_water, low value items (chat states, metrics and repeated status reports) are shed.
+    Everything else waits up to put_timeout for space, then is shed too and logged. Shed items are
+    counted in rejected, a multiprocessing.Value shared with Dispatch.
+    """
+    def __init__(self, target_queue, high_water, rejected, put_timeout=1):
+        self.queue = target_queue
+        self.high_water = high_water
+        self.rejected = rejected
+        self.put_timeout = put_timeout
+        self.last_status = {}  # {service or connection name: its last status, ...}
+        self.timed_out = 0  # Items shed after put_timeout since the queue last took one
+
+    def is_low_value(self, item):
+        if isinstance(item, dict):
+            return item.get('type') in ('chat_state', 'outbound_metrics')
+        if isinstance(item, tuple) and len(item) == 2:  # (service, status)
+            repeated = self.last_status.get(item[0]) == item[1]
+            self.last_status[item[0]] = item[1]
+            return repeated
+        return False
+
+    def put(self, item):
+        if self.is_low_value(item) and queue_depth(self.queue) >= self.high_water:
+            count_rejected(self.rejected)
+            return False
+        try:
+            self.queue.put(item, timeout=self.put_timeout)  # Back pressure on the connection's thread
+        except queue.Full:
+            if not self.timed_out:
+                logger.warning('Inbound queue full for %s seconds, dropping messages', self.put_timeout)
+            self.timed_out += 1
+            count_rejected(self.rejected)
+            return False
+        if self.timed_out:
+            logger.warning('Inbound queue accepting again, %d messages were dropped', self.timed_out)
+            self.timed_out = 0
+        return True
@@ -0,0 +1,199 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Connectors no longer reconnect from inside sleekxmpp's event handlers. The handlers only report what
+# happened, and the connector's own thread calls ReconnectSupervisor.poll(), which replaces a dropped
+# client with a fresh instance after an exponential, jittered back-off. A circuit breaker stops
+# attempts for a cool off period after repeated failures.
+
+import functools
+import queue
+import random
+import time
+from stream_management import make_stream_session, register_stream_management
+import logging
+logger = logging.getLogger(__name__)
+
+# Connection states, reported to Dispatch as they change.
+CONNECTING = 'connecting'
+CONNECTED = 'connected'  # Stream up, not yet authenticated
+ONLINE = 'session_start'
+RESUMED = 'session_resumed'  # XEP-0198, the previous session carried on without a new login
+DISCONNECTED = 'disconnected'
+CIRCUIT_OPEN = 'Circuit open'
+
+
+class Backoff(object):
+    def __init__(self, base=1, cap=300):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        """Random delay between base and base*2^attempt (at most cap), spreads out reconnect storms"""
+        delay = random.uniform(self.base, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class CircuitBreaker(object):
+    """Opens after threshold failures in a row, then allows one attempt per cool_off until one succeeds"""
+    def __init__(self, threshold=5, cool_off=300):
+        self.threshold = threshold
+        self.cool_off = cool_off
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self, now):
+        return self.opened_at is None or now - self.opened_at >= self.cool_off
+
+    def retry_at(self):
+        return 0 if self.opened_at is None else self.opened_at + self.cool_off
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+
+class ReconnectSupervisor(object):
+    """Owns a connector's XMPP client, only ever used from the connector's thread except on_status.
+
+    make_client(status_callback) returns a new, unconnected ClientXMPP that calls status_callback(arg) on
+    'connected', 'session_start', 'session_end', 'disconnected' and 'failed_auth'. connect(client) makes one
+    connection attempt, e.g. client.connect(reattempt=False). report(state) is called on each state change.
+    session is a stream_management.StreamSession, or None when stream management is off.
+    """
+    def __init__(self, name, make_client, connect, report, backoff=None, breaker=None, session_timeout=30,
+                 session=None):
+        self.name = name
+        self.make_client = make_client
+        self.connect = connect
+        self.report = report
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or CircuitBreaker()
+        self.session_timeout = session_timeout  # Seconds allowed from connecting to session_start
+        self.session = session
+        self.events = queue.Queue()  # (generation, arg) from sleekxmpp's event thread
+        self.client = None
+        self.generation = 0  # Events from replaced clients are ignored
+        self.state = DISCONNECTED
+        self.attempt_started = 0
+        self.retry_at = 0
+        self.stopped = False
+
+    def on_status(self, generation, arg):
+        self.events.put((generation, arg))
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.info('%s connection state: %s', self.name, state)
+            self.state = state
+            self.report(state)
+
+    def is_online(self):
+        return self.state == ONLINE
+
+    def poll(self):
+        """Applies status events, drops stalled attempts and reconnects when due"""
+        now = time.monotonic()
+        while True:
+            try:
+                generation, arg = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation or self.stopped:
+                continue
+            if arg in (ONLINE, RESUMED):
+                self.backoff.reset()
+                self.breaker.record_success()
+                if self.session is not None:
+                    if arg == RESUMED:
+                        self.session.resumed(self.client)
+                    else:
+                        self.session.started(self.client)
+                self.set_state(ONLINE)
+            elif arg == CONNECTED and self.state == CONNECTING:
+                self.set_state(CONNECTED)
+            elif arg in (DISCONNECTED, 'session_end') and self.client is not None:
+                self.drop(now)
+            elif arg == 'failed_auth':
+                self.report('failed_auth')
+        if self.stopped:
+            return
+        if self.state in (CONNECTING, CONNECTED) and now - self.attempt_started > self.session_timeout:
+            logger.info('%s session did not start within %ss', self.name, self.session_timeout)
+            self.drop(now)
+        if self.client is None and now >= self.retry_at:
+            if self.breaker.allow(now):
+                self.attempt(now)
+            else:
+                self.retry_at = self.breaker.retry_at()
+                self.set_state(CIRCUIT_OPEN)
+
+    def attempt(self, now):
+        self.generation += 1
+        self.client = self.make_client(functools.partial(self.on_status, self.generation))
+        self.client.auto_reconnect = False  # sleekxmpp would otherwise reconnect on its own threads
+        if self.session is not None:
+            register_stream_management(self.client, self.session.window)
+            self.session.restore(self.client)
+        self.attempt_started = now
+        self.set_state(CONNECTING)
+        if self.connect(self.client):
+            self.client.process()
+        else:
+            self.drop(now)
+
+    def drop(self, now):
+        """Retires the current client and schedules the next attempt"""
+        was_online = self.state == ONLINE
+        if not was_online:  # Only attempts that never got a session count towards the breaker
+            self.breaker.record_failure(now)
+        self.retire()
+        if was_online and self.session is not None and self.session.sm_id is not None:
+            delay = 0  # Try to resume straight away, the server only keeps the session for a short while
+        else:
+            delay = self.backoff.next_delay()
+        self.retry_at = now + delay
+        self.set_state(DISCONNECTED)
+        logger.info('%s reconnecting in %.1fs', self.name, delay)
+
+    def retire(self, send_close=False):
+        """Drops the current client, without closing the stream unless asked so it can still be resumed"""
+        client, self.client = self.client, None
+        self.generation += 1
+        if client is not None:
+            if self.session is not None:
+                try:
+                    self.session.capture(client)
+                except Exception:  # Losing the session only costs a fresh login, losing the thread costs more
+                    logger.warning('%s stream state not captured', self.name, exc_info=True)
+                    self.session.clear()
+            try:
+                client.disconnect(wait=False, send_close=send_close)
+            except Exception:
+                logger.debug('%s disconnect failed', self.name, exc_info=True)
+
+    def stop(self):
+        self.stopped = True
+        self.retire(send_close=True)
+
+
+def make_reconnect_supervisor(options, name, make_client, connect, report):
+    """Back-off and circuit breaker settings come from 'reconnect_*' and 'circuit_breaker_*' in settings.ini"""
+    backoff = Backoff(float(options.get('reconnect_base_delay', 1)), float(options.get('reconnect_max_delay', 300)))
+    breaker = CircuitBreaker(int(options.get('circuit_breaker_failures', 5)),
+                             float(options.get('circuit_breaker_cool_off', 300)))
+    return ReconnectSupervisor(name, make_client, connect, report, backoff, breaker,
+                               session=make_stream_session(options))
@@ -0,0 +1,24 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# A ring no longer goes to every active client. It goes to the fanout best ready clients in its group, and
+# each time nobody answers within widen_after seconds the next wave rings twice as many as the last.
+
+
+class RingRouter(object):
+    """Chooses which clients each wave of a ring goes to, see SessionRegistry.best_ready for the order"""
+    def __init__(self, sessions, fanout=3, widen_after=10):
+        self.sessions = sessions
+        self.fanout = fanout
+        self.widen_after = widen_after
+
+    def ring_group(self, service):
+        """The routing key of a user's ring, clients name the groups they take at the 'key' handshake"""
+        return service
+
+    def next_wave(self, group, rung, wave):
+        """The ready clients to ring in this wave, excluding those already rung"""
+        return self.sessions.best_ready(group, self.fanout * 2 ** wave, rung)
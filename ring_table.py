@@ -0,0 +1,77 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class Ring(object):
+    """A user's ring waiting for a client to answer, text is what the user sent meanwhile"""
+    __slots__ = ('ID', 'address', 'text', 'service', 'group', 'rung', 'wave', 'expires', 'timeout_handle',
+                 'widen_handle')
+
+    def __init__(self, ring_id, address, service, group, expires, text=None):
+        self.ID = ring_id
+        self.address = address
+        self.text = list(text or ())
+        self.service = service
+        self.group = group
+        self.rung = set()  # uuids of the clients rung so far
+        self.wave = 0
+        self.expires = expires  # time.time() clients are told the ring ends at
+        self.timeout_handle = None  # TimerHandles of the ring's expiry and next wave
+        self.widen_handle = None
+
+    def to_dict(self):
+        """Everything but the timer handles, which only mean something in this process"""
+        return {'ID': self.ID, 'address': self.address, 'text': list(self.text), 'service': self.service,
+                'group': self.group, 'rung': sorted(self.rung), 'wave': self.wave, 'expires': self.expires}
+
+
+class RingTable(object):
+    """Rings indexed by ID and by user address, oldest first"""
+    def __init__(self):
+        self.lock = Lock()  # Guards both indexes, the admin interface reads them
+        self.by_id = OrderedDict()  # {ring ID: Ring, ...}
+        self.by_address = {}  # {str(address): ring ID, ...}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, ring):
+        self.lock.acquire_lock()
+        self.by_id[ring.ID] = ring
+        self.by_address[str(ring.address)] = ring.ID
+        self.lock.release_lock()
+        return ring
+
+    def get(self, ring_id):
+        return self.by_id.get(ring_id)
+
+    def find_address(self, address):
+        ring_id = self.by_address.get(str(address))
+        return None if ring_id is None else self.by_id.get(ring_id)
+
+    def pop(self, ring_id):
+        """Removes the ring and cancels its timers, returns it or None if it already ended"""
+        self.lock.acquire_lock()
+        ring = self.by_id.pop(ring_id, None)
+        if ring is not None:
+            self.by_address.pop(str(ring.address), None)
+        self.lock.release_lock()
+        if ring is not None:
+            for handle in (ring.timeout_handle, ring.widen_handle):
+                if handle is not None:
+                    handle.cancel()
+        return ring
+
+    def rings(self):
+        """Snapshot of the rings, oldest first"""
+        self.lock.acquire_lock()
+        rings = list(self.by_id.values())
+        self.lock.release_lock()
+        return rings
@@ -0,0 +1,226 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# Based on the sleekxmpp echotest
+# A service (Facebook, Zoho) has any number of '[account <service> ...]' sections in settings.ini. Each account
+# gets a ServiceConnector with its own outgoing queue. All accounts of a service share one incoming queue and tag
+# what they put on it with their account name, so replies to a user go out through the account they arrived on.
+
+import multiprocessing
+from collections import OrderedDict
+from threading import Thread
+import time
+import sleekxmpp
+from outbound_scheduler import OutboundScheduler, pump_outbound
+from reconnect import make_reconnect_supervisor
+from stanza_templates import MessageTemplate
+import logging
+logger = logging.getLogger(__name__)
+
+# {service: {'account': settings.ini account prefix, 'server': (host, port) or None for DNS lookup,
+#            'unescape_username': settings.ini doubles the backslash in '\40' usernames}, ...}
+SERVICES = OrderedDict([
+    ('Facebook', {'account': 'facebook', 'server': None, 'unescape_username': False}),
+    ('Zoho', {'account': 'zoho', 'server': ('zchat.zoho.com', 5222), 'unescape_username': True}),
+])
+
+
+def service_accounts(options, service):
+    """Returns [(account, username, password), ...] for '<prefix>' and any '<prefix> <n>' accounts"""
+    prefix = SERVICES[service]['account']
+    accounts = []
+    for account in sorted(options['accounts']):
+        if account == prefix or account.startswith(prefix+' '):
+            username = options['accounts'][account]['username']
+            if SERVICES[service]['unescape_username']:
+                username = username.replace('\\\\', '\\')
+            accounts.append((account, username, options['accounts'][account]['password']))
+    return accounts
+
+
+class ServiceXMPP(sleekxmpp.ClientXMPP):
+    """A user facing XMPP account, messages are put on incoming_queue tagged with the account name"""
+    def __init__(self, service, account, jid, password, incoming_queue, status_callback):
+        sleekxmpp.ClientXMPP.__init__(self, jid, password)
+        self.service = service
+        self.account = account
+        self.jid = jid
+        self.incoming_queue = incoming_queue
+        self.status_callback = status_callback  # ReconnectSupervisor.on_status, reconnecting is left to it
+        self.templates = MessageTemplate(self)
+        self.register_plugin('xep_0004')  # Data Forms
+        self.register_plugin('xep_0030')  # Service Discovery
+        self.register_plugin('xep_0060')  # PubSub
+        self.register_plugin('xep_0054')  # vcard-temp
+        self.register_plugin('xep_0153')
+        self.register_plugin('xep_0199', {'keepalive': True, 'frequency': 60})  # XMPP Ping
+        self.register_plugin('xep_0085')  # Chat State Notifications
+
+        self.add_event_handler("session_start", self.start)
+        self.add_event_handler("session_resumed", lambda stanza: self.status_report("session_resumed"))
+        self.add_event_handler("message", self.process_message)
+        self.add_event_handler("session_end", lambda event: self.status_report("session_end"))
+        self.add_event_handler("disconnected", lambda event: self.status_report("disconnected"))
+        self.add_event_handler("connected", lambda event: self.status_report("connected"))
+        self.add_event_handler('chatstate_composing', self._on_typing_message_cb)
+        self.add_event_handler('chatstate_paused', self._on_typing_message_cb)
+        self.add_event_handler('chatstate_active', self._on_typing_message_cb)
+        self.add_event_handler('chatstate_inactive', self._on_typing_message_cb)
+        self.add_event_handler('chatstate_gone', self._on_typing_message_cb)
+        self.add_event_handler('failed_auth', self._on_failed_auth)
+
+    def connect_service(self):
+        """One connection attempt, retries are up to the ReconnectSupervisor"""
+        return self.connect(SERVICES[self.service]['server'] or tuple(), reattempt=False)
+
+    def _on_typing_message_cb(self, message):
+        self.incoming_queue.put({'type': 'chat_state', 'state': message['chat_state'], 'address': message['from'],
+                                 'account': self.account})
+
+    def start(self, event):
+        self.send_presence()
+        self.get_roster(block=False)  # Nothing waits on the roster, don't hold up the session for it
+        self.status_report("session_start")
+
+    def _on_failed_auth(self, direct):
+        logger.warning("Authentication failed: %s", self.account)
+        self.status_report('failed_auth')
+
+    def status_report(self, arg):
+        self.status_callback(arg)
+
+    def process_message(self, msg):
+        if msg['type'] in ('chat', 'normal'):
+            try:
+                self.incoming_queue.put(('msg', msg['from'], msg['body'], self.account))
+            except:  # TODO Narrow exception
+                logger.info('%s put msg queue fail', self.account)
+
+    def reply_message(self, user_id, text, state='active'):
+        self.templates.build(str(user_id), text, state).send()
+
+    def send_batch(self, items):
+        """Sends [(user_id, text, state), ...] in one pass, still one stanza each for stream management"""
+        for user_id, text, state in items:
+            self.templates.build(str(user_id), text, state).send()
+
+
+def make_outbound_scheduler(options, service):
+    """Token bucket rates come from '<service>_outbound_rate/burst', falling back to 'outbound_rate/burst'"""
+    rate = float(options.get(service.lower()+'_outbound_rate', options.get('outbound_rate', 5)))
+    burst = float(options.get(service.lower()+'_outbound_burst', options.get('outbound_burst', 10)))
+    return OutboundScheduler(rate, burst)
+
+
+class OutboundMetricsTimer(object):
+    """Reports a scheduler's lane metrics to Dispatch through the service's incoming queue"""
+    def __init__(self, incoming_queue, scheduler, account, interval=10):
+        self.incoming_queue = incoming_queue
+        self.scheduler = scheduler
+        self.account = account
+        self.interval = interval
+        self.last_report = time.monotonic()
+
+    def tick(self):
+        if time.monotonic() - self.last_report >= self.interval:
+            self.last_report = time.monotonic()
+            self.incoming_queue.put({'type': 'outbound_metrics', 'lanes': self.scheduler.metrics(),
+                                     'account': self.account})
+
+
+class ServiceConnector(Thread):
+    """Runs one account of a service, sending what Dispatch puts on outgoing_queue at the paced rate"""
+    def __init__(self, kill_event, service, account, username, password, incoming_queue, options,
+                 outgoing_queue=None):
+        super().__init__()
+        self.kill_event = kill_event
+        self.service = service
+        self.account = account
+        self.username = username
+        self.password = password
+        self.incoming_queue = incoming_queue
+        # (user_address, text, state, lane)
+        self.outgoing_queue = multiprocessing.Queue() if outgoing_queue is None else outgoing_queue
+        self.options = options
+
+    def spec(self):
+        """(class, kwargs) to build this connector again in a child process, see connector_process"""
+        return ServiceConnector, {'kill_event': self.kill_event, 'service': self.service, 'account': self.account,
+                                  'username': self.username, 'password': self.password,
+                                  'incoming_queue': self.incoming_queue, 'options': self.options,
+                                  'outgoing_queue': self.outgoing_queue}
+
+    def label(self):
+        """The service name, with the account's suffix when there are several: 'Facebook', 'Facebook 2'"""
+        return ' '.join([self.service] + self.account.split(' ')[1:])
+
+    def run(self):
+        supervisor = make_reconnect_supervisor(
+            self.options, self.account,
+            lambda callback: ServiceXMPP(self.service, self.account, self.username, self.password,
+                                         self.incoming_queue, callback),
+            lambda msger: msger.connect_service(),
+            lambda state: self.incoming_queue.put((self.label(), state)))
+        scheduler = make_outbound_scheduler(self.options, self.service)  # Per account, each has its own limits
+        metrics = OutboundMetricsTimer(self.incoming_queue, scheduler, self.account)
+        while True:  # main thread loop
+            supervisor.poll()
+            # While the connection is down messages wait in the scheduler, not sent to a dead stream.
+            pump_outbound(self.outgoing_queue, scheduler,
+                          supervisor.client.send_batch if supervisor.is_online() else None)
+            metrics.tick()
+            if self.kill_event.is_set():
+                supervisor.stop()
+                logger.info('Thread ending: %s', self.account)
+                break
+        return
+
+
+class ServiceQueues(object):
+    """Dispatch's side of a service: the shared incoming queue and sticky routing to the accounts' out queues"""
+    def __init__(self, service, incoming_queue, outgoing_queues, max_routes=10000):
+        self.service = service
+        self.incoming_queue = incoming_queue
+        self.outgoing_queues = outgoing_queues  # OrderedDict({account: queue, ...}) the first is the default
+        self.routes = OrderedDict()  # {str(address): account, ...} least recently seen first
+        self.max_routes = max_routes
+
+    def note(self, address, account):
+        """Remembers the account a user's message arrived on"""
+        if account not in self.outgoing_queues:
+            return
+        key = str(address)
+        self.routes[key] = account
+        self.routes.move_to_end(key)
+        if len(self.routes) > self.max_routes:
+            self.routes.popitem(last=False)
+
+    def put(self, address, item):
+        account = self.routes.get(str(address))
+        if account is None:
+            account = next(iter(self.outgoing_queues))
+        self.outgoing_queues[account].put(item)
+
+
+def make_service_connectors(kill_event, options, make_incoming_gate, queue_size):
+    """Returns ({service: ServiceQueues, ...}, [ServiceConnector, ...]) for every configured service account.
+
+    make_incoming_gate(queue) wraps a service's incoming queue for the connectors, see overload.InboundGate.
+    """
+    service_queues, connectors = OrderedDict(), []
+    for service in SERVICES:
+        accounts = service_accounts(options, service)
+        if not accounts:
+            continue
+        incoming_queue = multiprocessing.Queue(queue_size)
+        gate = make_incoming_gate(incoming_queue)
+        outgoing_queues = OrderedDict()
+        for account, username, password in accounts:
+            connector = ServiceConnector(kill_event, service, account, username, password, gate, options)
+            outgoing_queues[account] = connector.outgoing_queue
+            connectors.append(connector)
+        service_queues[service] = ServiceQueues(service, incoming_queue, outgoing_queues)
+    return service_queues, connectors
@@ -0,0 +1,218 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+
+from threading import Lock
+import heapq
+import itertools
+import time
+
+
+class Association(object):
+    """A conversation between a user's address on a service and a client, ID is the ring that started it"""
+    __slots__ = ('UUID', 'address', 'service', 'ID')
+
+    def __init__(self, uuid, address, service, conversation=None):
+        self.UUID = uuid
+        self.address = address
+        self.service = service
+        self.ID = conversation
+
+    def to_dict(self):
+        return {'UUID': self.UUID, 'address': self.address, 'service': self.service, 'ID': self.ID}
+
+
+class SessionRegistry(object):
+    """Indexes active clients and their address associations for O(1) lookups.
+
+    A client takes up to its capacity conversations at once, set at the 'key' handshake. Load counters are
+    kept as conversations start and end, and ready clients (load below capacity) sit in a heap per ring group
+    ordered by load then idle time, so choosing the best ready clients costs O(log n) each.
+    """
+    def __init__(self, max_capacity=5):
+        self.lock = Lock()  # Guards everything below
+        self.max_capacity = max_capacity
+        self.active = {}  # {uuid: None, ...} Used as an insertion ordered set of active clients.
+        self.ready = set()  # Active clients with spare capacity.
+        self.by_address = {}  # {str(address): Association, ...}
+        self.by_uuid = {}  # {uuid: {conversation ID: Association, ...}, ...}
+        self.capacity = {}  # {uuid: conversations it takes at once, ...} 1 unless set
+        self.load = {}  # {uuid: conversations it has, ...}
+        self.idle_since = {}  # {uuid: time.monotonic() a conversation of the client last ended, ...}
+        self.groups = {}  # {uuid: set of ring groups, ...} Clients that named no groups take rings of any group
+        # {group: [(load, idle_since, version, uuid), ...], ...} The None heap holds clients of every group.
+        # An entry is stale once versions[uuid] has moved on, stale entries are dropped as they surface.
+        # Versions come from one counter, so a client that reconnects never revives its old entries.
+        self.heaps = {}
+        self.versions = {}
+        self.version_counter = itertools.count(1)
+
+    def _reindex(self, uuid):
+        """Call with the lock held, after anything that changes the client's readiness or order"""
+        self.versions[uuid] = next(self.version_counter)
+        if uuid in self.active and self.load.get(uuid, 0) < self.capacity.get(uuid, 1):
+            self.ready.add(uuid)
+            entry = (self.load.get(uuid, 0), self.idle_since.get(uuid, 0), self.versions[uuid], uuid)
+            for group in self.groups.get(uuid) or (None,):
+                heap = self.heaps.setdefault(group, [])
+                heapq.heappush(heap, entry)
+                if len(heap) > 4 * len(self.active) + 64:  # Mostly stale, rebuild it
+                    self.heaps[group] = [item for item in heap if self._is_current(item)]
+                    heapq.heapify(self.heaps[group])
+        else:
+            self.ready.discard(uuid)
+
+    def _is_current(self, entry):
+        return self.versions.get(entry[3]) == entry[2]
+
+    def add_active(self, uuid):
+        self.lock.acquire_lock()
+        if uuid not in self.active:
+            self.active[uuid] = None
+            self.idle_since.setdefault(uuid, time.monotonic())
+            self._reindex(uuid)
+        self.lock.release_lock()
+
+    def remove_active(self, uuid):
+        self.lock.acquire_lock()
+        self.active.pop(uuid, None)
+        self.ready.discard(uuid)
+        self.versions.pop(uuid, None)
+        if uuid not in self.by_uuid:
+            for index in (self.capacity, self.load, self.idle_since, self.groups):
+                index.pop(uuid, None)
+        self.lock.release_lock()
+
+    def is_active(self, uuid):
+        return uuid in self.active
+
+    def active_list(self):
+        self.lock.acquire_lock()
+        active = list(self.active)
+        self.lock.release_lock()
+        return active
+
+    def set_capacity(self, uuid, capacity):
+        try:
+            capacity = max(1, min(int(capacity), self.max_capacity))
+        except (TypeError, ValueError, OverflowError):  # From the client's handshake, so anything goes
+            capacity = 1
+        self.lock.acquire_lock()
+        self.capacity[uuid] = capacity
+        self._reindex(uuid)
+        self.lock.release_lock()
+
+    def set_groups(self, uuid, groups):
+        if not isinstance(groups, (list, tuple)):  # From the client's handshake, a bad value means every group
+            groups = []
+        groups = set(group for group in groups if isinstance(group, str))
+        self.lock.acquire_lock()
+        self.groups[uuid] = groups
+        self._reindex(uuid)
+        self.lock.release_lock()
+
+    def has_capacity(self, uuid):
+        return uuid in self.ready
+
+    def associate(self, uuid, address, service, conversation=None):
+        association = Association(uuid, address, service, conversation)
+        self.lock.acquire_lock()
+        self.by_address[str(address)] = association
+        self.by_uuid.setdefault(uuid, {})[conversation] = association
+        self.load[uuid] = len(self.by_uuid[uuid])
+        self._reindex(uuid)
+        self.lock.release_lock()
+        return association
+
+    def disassociate(self, uuid, conversation=None):
+        """Ends one of the client's conversations, or all of them, returns [Association, ...] removed"""
+        self.lock.acquire_lock()
+        conversations = self.by_uuid.get(uuid, {})
+        if conversation is None:
+            removed = list(conversations.values())
+            conversations.clear()
+        else:
+            removed = [conversations.pop(conversation)] if conversation in conversations else []
+        for association in removed:
+            self.by_address.pop(str(association.address), None)
+        if not conversations:
+            self.by_uuid.pop(uuid, None)
+        if removed:
+            self.load[uuid] = len(conversations)
+            self.idle_since[uuid] = time.monotonic()
+            self._reindex(uuid)
+        self.lock.release_lock()
+        return removed
+
+    def find_address(self, address):
+        return self.by_address.get(str(address))
+
+    def find_uuid(self, uuid, conversation=None):
+        """The client's conversation with that ID, or its first one when conversation is None"""
+        conversations = self.by_uuid.get(uuid)
+        if not conversations:
+            return None
+        if conversation is None:
+            return next(iter(conversations.values()))
+        return conversations.get(conversation)
+
+    def conversations(self, uuid):
+        return list(self.by_uuid.get(uuid, {}).values())
+
+    def associations(self):
+        self.lock.acquire_lock()
+        associations = [association for conversations in self.by_uuid.values()
+                        for association in conversations.values()]
+        self.lock.release_lock()
+        return associations
+
+    def all_clients_full(self):
+        return not self.ready
+
+    def spare_capacity(self):
+        """Conversations the ready clients can still take between them"""
+        self.lock.acquire_lock()
+        spare = sum(self.capacity.get(uuid, 1) - self.load.get(uuid, 0) for uuid in self.ready)
+        self.lock.release_lock()
+        return spare
+
+    def best_ready(self, group, count, exclude=()):
+        """Up to count ready clients serving group and not in exclude, least loaded then longest idle first"""
+        self.lock.acquire_lock()
+        heaps = [heap for heap in (self.heaps.get(group), self.heaps.get(None)) if heap]
+        chosen, popped = [], []
+        while len(chosen) < count:
+            best = None
+            for heap in heaps:
+                while heap and not self._is_current(heap[0]):
+                    heapq.heappop(heap)
+                if heap and (best is None or heap[0] < best[0]):
+                    best = heap
+            if best is None:
+                break
+            entry = heapq.heappop(best)
+            popped.append((best, entry))
+            if entry[3] not in exclude and entry[3] not in chosen:
+                chosen.append(entry[3])
+        for heap, entry in popped:  # Choosing doesn't change anyone's load
+            heapq.heappush(heap, entry)
+        self.lock.release_lock()
+        return chosen
+
+    def snapshot(self):
+        """Active clients, their capacity and groups, and every association, as JSON types"""
+        self.lock.acquire_lock()
+        snapshot = {'active': list(self.active),
+                    'capacity': {uuid: self.capacity[uuid] for uuid in self.active if uuid in self.capacity},
+                    'groups': {uuid: sorted(self.groups[uuid]) for uuid in self.active if uuid in self.groups},
+                    'associations': [association.to_dict() for conversations in self.by_uuid.values()
+                                     for association in conversations.values()]}
+        self.lock.release_lock()
+        return snapshot
+
+    def load_stats(self):
+        return {uuid: {'load': self.load.get(uuid, 0), 'capacity': self.capacity.get(uuid, 1)}
+                for uuid in self.active_list()}
@@ -0,0 +1,49 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# The connectors' send path. Stanza plugins are registered once at import, JIDs are parsed once and cached,
+# and each message is a copy of a pre-built template rather than a stanza built from scratch.
+
+import copy
+from sleekxmpp import Message, JID
+from sleekxmpp.xmlstream import register_stanza_plugin
+from sleekxmpp.plugins.xep_0085.stanza import ChatState
+
+register_stanza_plugin(Message, ChatState)
+
+
+class JIDCache(object):
+    """Parsed JIDs of prefix+key by key, emptied when it grows past max_size"""
+    def __init__(self, prefix='', max_size=10000):
+        self.prefix = prefix
+        self.jids = {}
+        self.max_size = max_size
+
+    def get(self, key):
+        cached = self.jids.get(key)
+        if cached is None:
+            if len(self.jids) >= self.max_size:
+                self.jids.clear()
+            cached = self.jids[key] = JID(self.prefix+key)
+        return cached
+
+
+class MessageTemplate(object):
+    """A chat message from the client's account, copied for each message sent"""
+    def __init__(self, client, mtype='chat'):
+        self.template = client.Message()
+        self.template['type'] = mtype
+        self.template['from'] = client.jid
+        self.jids = JIDCache()
+
+    def build(self, to, body, chat_state=None):
+        """to is a JID or a JID string"""
+        msg = copy.copy(self.template)
+        msg['to'] = to if isinstance(to, JID) else self.jids.get(to)
+        msg['body'] = body
+        if chat_state is not None:
+            msg['chat_state'] = chat_state
+        return msg
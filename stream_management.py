@@ -0,0 +1,98 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# XEP-0198 stream management for the connectors, 'stream_management = 1' in settings.ini.
+# sleekxmpp's xep_0198 plugin keeps the session id, the stanza counters and the unacked queue on the client,
+# but ReconnectSupervisor builds a fresh client for every attempt. StreamSession carries that state from the
+# retired client to the next one, so it can <resume> the old session instead of logging in again. On <resumed>
+# the plugin itself drops what the server acked and resends the rest, when resuming fails StreamSession resends
+# everything the old stream had not had acked.
+
+from sleekxmpp.plugins.xep_0198.stanza import Failed
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import MatchXPath
+import logging
+logger = logging.getLogger(__name__)
+
+SM_PLUGIN = 'xep_0198'
+MAX_SEQ = 2 ** 32  # Stanza counters wrap, as in sleekxmpp's plugin
+
+
+def register_stream_management(client, window=5):
+    """Requests an ack from the server every window stanzas and asks for a resumable session"""
+    client.register_plugin(SM_PLUGIN, {'window': window, 'allow_resume': True})
+
+
+class StreamSession(object):
+    """Stream management state handed from one ReconnectSupervisor client to the next"""
+    def __init__(self, window=5):
+        self.window = window
+        self.sm_id = None  # None until the server enabled a resumable session
+        self.handled = 0  # Inbound stanzas handled, sent as 'h' in <resume>
+        self.seq = 0  # Outbound stanzas sent
+        self.last_ack = 0
+        self.unacked = []  # [(seq, stanza), ...] sent but not acked by the server
+
+    def capture(self, client):
+        """Saves the client's state, from its session_end or before it is retired"""
+        sm = client.plugin[SM_PLUGIN]
+        if not sm.sm_id:  # Never got a resumable session, keep what an earlier client left
+            return
+        self.sm_id, self.handled, self.seq, self.last_ack = sm.sm_id, sm.handled, sm.seq, sm.last_ack
+        self.unacked = list(sm.unacked_queue)  # A collections.deque of (seq, stanza)
+        logger.debug('Stream %s captured with %s unacked stanzas', self.sm_id, len(self.unacked))
+
+    def restore(self, client):
+        """Primes a fresh client so its stream negotiation tries <resume> first"""
+        sm = client.plugin[SM_PLUGIN]
+        # Without sleekxmpp's own reconnecting every dropped stream ends the session, and the plugin's
+        # session_end handler wipes the state to resume with. Capture it first.
+        client.del_event_handler('session_end', sm.session_end)
+        client.add_event_handler('session_end', lambda event: self.session_end(client, event))
+        if self.sm_id is None:
+            return
+        sm.sm_id, sm.handled, sm.seq, sm.last_ack = self.sm_id, self.handled, self.seq, self.last_ack
+        # The plugin pops what <resumed h=...> acks from its queue and resends the rest.
+        sm.unacked_queue.extend(self.unacked)
+        # In the stream's own thread, so the session id is gone before the plugin's enable step looks at it.
+        client.register_handler(Callback('Stream Management Resume Failed', MatchXPath(Failed.tag_name()),
+                                         lambda stanza: self.resume_failed(sm), instream=True))
+
+    def session_end(self, client, event):
+        self.capture(client)
+        client.plugin[SM_PLUGIN].session_end(event)
+
+    def resume_failed(self, sm):
+        """The server no longer knows the session, forget it so the client enables a new one after binding"""
+        logger.info('Stream %s could not be resumed', self.sm_id)
+        sm.sm_id = None
+        sm.handled = sm.seq = sm.last_ack = 0
+
+    def resumed(self, client):
+        """The plugin has resent what the server's <resumed h=...> did not ack"""
+        logger.info('Stream %s resumed, %s stanzas resent', self.sm_id, len(client.plugin[SM_PLUGIN].unacked_queue))
+        self.unacked = []
+
+    def started(self, client):
+        """A new session, the old one could not be resumed, so every captured stanza is resent"""
+        resend = self.unacked
+        self.clear()
+        for seq, stanza in resend:
+            client.send(stanza)
+        if resend:
+            logger.info('Stream not resumed, %s stanzas resent', len(resend))
+
+    def clear(self):
+        """Nothing to resume, the next client logs in from scratch"""
+        self.sm_id = None
+        self.handled = self.seq = self.last_ack = 0
+        self.unacked = []
+
+
+def make_stream_session(options):
+    if int(options.get('stream_management', 1)):
+        return StreamSession(int(options.get('stream_management_window', 5)))
+    return None
@@ -0,0 +1,109 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# XEP-0198 resumption of a connector's stream, with a real sleekxmpp client against the stand-in server.
+
+import os
+import queue
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reconnect import ReconnectSupervisor, Backoff, CircuitBreaker
+from service_connector import ServiceXMPP
+from stream_management import StreamSession, SM_PLUGIN
+from xmpp_stand_in import StandInServer
+
+USER = 'user@stand-in.test'
+
+
+class StreamResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.states = []
+        self.supervisor = ReconnectSupervisor('stand-in', self.make_client, self.connect, self.states.append,
+                                              Backoff(0.01, 0.01), CircuitBreaker(100, 1), session_timeout=10,
+                                              session=StreamSession(window=1))
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.server.stop()
+
+    def make_client(self, status_callback):
+        return ServiceXMPP('Zoho', 'zoho', 'connector@stand-in.test', 'secret', queue.Queue(), status_callback)
+
+    def connect(self, client):
+        client['feature_mechanisms'].config['unencrypted_plain'] = True  # The stand-in has no TLS
+        return client.connect(self.server.address, use_tls=False, reattempt=False)
+
+    def poll_until(self, predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.supervisor.poll()
+            if predicate():
+                return
+            time.sleep(0.02)
+        self.fail('Timed out, connection states: %s' % self.states)
+
+    def sm(self):
+        return self.supervisor.client.plugin[SM_PLUGIN]
+
+    def send(self, *texts):
+        self.supervisor.client.send_batch([(USER, text, 'active') for text in texts])
+
+    def ack_everything(self):
+        """Waits for the server to handle everything sent so far, then has it ack it"""
+        self.poll_until(lambda: self.server.sessions.get(self.sm().sm_id) == self.sm().seq)
+        self.server.ack()
+        self.poll_until(lambda: self.sm().last_ack == self.sm().seq)
+
+    def start_and_lose(self):
+        """Online with 'one' acked, 'two' received but not acked and 'three' lost when the connection is cut"""
+        self.poll_until(lambda: self.supervisor.is_online() and self.sm().sm_id)
+        self.server.acking = False
+        self.send('one')
+        self.ack_everything()
+        self.server.lose = {'three'}
+        self.send('two', 'three')
+        self.poll_until(lambda: len(self.sm().unacked_queue) == 2 and 'two' in self.server.bodies)
+        time.sleep(0.2)  # Let 'three' reach the server and be lost
+        self.server.lose = set()
+        self.server.acking = True
+        self.server.cut()
+
+    def test_resume_resends_only_what_the_server_missed(self):
+        self.start_and_lose()
+        self.poll_until(lambda: self.server.resumes == 1 and self.supervisor.is_online())
+        self.poll_until(lambda: 'three' in self.server.bodies)
+        self.assertEqual(self.server.bodies, ['one', 'two', 'three'])
+        self.assertEqual(self.server.binds, 1)  # Resumed, not logged in again
+        self.assertEqual(self.states.count('session_start'), 2)  # Reported online again after resuming
+
+    def test_failed_resume_logs_in_again_and_resends_everything_unacked(self):
+        self.server.resumable = False
+        self.start_and_lose()
+        self.poll_until(lambda: self.server.binds == 2 and self.supervisor.is_online())
+        self.poll_until(lambda: 'three' in self.server.bodies)
+        self.assertEqual(self.server.bodies[:2], ['one', 'two'])
+        self.assertEqual(sorted(self.server.bodies[2:]), ['three', 'two'])  # 'two' was never acked
+        self.poll_until(lambda: self.sm().sm_id is not None)
+        self.assertNotEqual(self.sm().sm_id, 'sm0')  # A new session the next drop can resume
+
+    def test_stop_with_a_resumable_session(self):
+        self.poll_until(lambda: self.supervisor.is_online() and self.sm().sm_id)
+        self.server.acking = False
+        self.ack_everything()
+        self.send('one')
+        self.poll_until(lambda: 'one' in self.server.bodies)
+        self.supervisor.stop()
+        unacked = self.supervisor.session.unacked
+        self.assertEqual([stanza['body'] for seq, stanza in unacked], ['one'])
+
+
+if __name__ == '__main__':
+    unittest.main()
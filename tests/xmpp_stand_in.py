@@ -0,0 +1,189 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# A stand-in XMPP server on localhost, just enough of one for sleekxmpp clients: SASL PLAIN without TLS,
+# resource binding, sessions and XEP-0198 stream management with resumption. Tests choose when it acks,
+# which messages it loses and when it cuts the connections.
+
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+STREAMS = 'http://etherx.jabber.org/streams'
+SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+SM = 'urn:xmpp:sm:3'
+CLIENT = 'jabber:client'
+
+
+class StandInServer(object):
+    def __init__(self, domain='stand-in.test'):
+        self.domain = domain
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.address = self.listener.getsockname()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.streams = []
+        self.sessions = {}  # {sm id: stanzas from the client the server has handled, ...}
+        self.bodies = []  # Message bodies received, in order
+        self.acking = True  # Answer the client's <r/> with <a/>
+        self.lose = set()  # Message bodies that never arrive, as if lost with the connection
+        self.resumable = True  # False forgets every session, so <resume/> fails
+        # sleekxmpp 1.3.1 only starts waiting for <resumed/> after sending <resume/>, which a real server's
+        # round trip allows for but a localhost one doesn't.
+        self.round_trip = 0.05
+        self.binds = 0
+        self.resumes = 0
+        self.changed = threading.Condition(self.lock)
+        self.stopped = False
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while not self.stopped:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections.append(conn)
+            stream = StandInStream(self, conn)
+            with self.lock:
+                self.streams.append(stream)
+            threading.Thread(target=stream.run, daemon=True).start()
+
+    def ack(self):
+        """Acks everything handled so far without waiting for the client's <r/>, which sleekxmpp sends before
+        the stanza it asks about"""
+        with self.lock:
+            for stream in self.streams:
+                if stream.sm_id is not None:
+                    stream.send("<a xmlns='%s' h='%d'/>" % (SM, self.sessions[stream.sm_id]))
+
+    def cut(self):
+        """Drops every connection without closing the streams, as a network failure would"""
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.streams = []
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def wait_for(self, predicate, timeout=10):
+        with self.changed:
+            return self.changed.wait_for(predicate, timeout)
+
+    def stop(self):
+        self.stopped = True
+        self.cut()
+        self.listener.close()
+
+
+class StandInStream(object):
+    """One client connection"""
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.authed = False
+        self.sm_id = None
+
+    def send(self, data):
+        try:
+            self.conn.sendall(bytes(data, encoding='utf'))
+        except OSError:
+            pass
+
+    def run(self):
+        parser = self.new_parser()
+        depth = 0
+        while True:
+            try:
+                data = self.conn.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            parser.feed(data)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        self.open_stream()
+                elif event == 'end':
+                    depth -= 1
+                    if depth == 1:
+                        if self.handle(elem):  # Stream restart, after SASL
+                            parser, depth = self.new_parser(), 0
+                            break
+                    elif depth == 0:
+                        self.send('</stream:stream>')
+                        return
+
+    def new_parser(self):
+        return ET.XMLPullParser(['start', 'end'])
+
+    def open_stream(self):
+        self.send("<?xml version='1.0'?><stream:stream xmlns='jabber:client' xmlns:stream='%s' "
+                  "from='%s' id='s1' version='1.0'>" % (STREAMS, self.server.domain))
+        if self.authed:
+            features = "<bind xmlns='%s'/><session xmlns='%s'/><sm xmlns='%s'/>" % (BIND, SESSION, SM)
+        else:
+            features = "<mechanisms xmlns='%s'><mechanism>PLAIN</mechanism></mechanisms>" % SASL
+        self.send('<stream:features>%s</stream:features>' % features)
+
+    def handle(self, elem):
+        tag = elem.tag
+        server = self.server
+        if tag == '{%s}auth' % SASL:
+            self.authed = True
+            self.send("<success xmlns='%s'/>" % SASL)
+            return True
+        with server.changed:
+            if self.sm_id is not None and tag in ('{%s}message' % CLIENT, '{%s}iq' % CLIENT,
+                                                  '{%s}presence' % CLIENT):
+                body = elem.findtext('{%s}body' % CLIENT)
+                if body in server.lose:
+                    return False
+                server.sessions[self.sm_id] += 1
+            if tag == '{%s}message' % CLIENT:
+                server.bodies.append(elem.findtext('{%s}body' % CLIENT))
+            elif tag == '{%s}iq' % CLIENT:
+                self.handle_iq(elem)
+            elif tag == '{%s}enable' % SM:
+                self.sm_id = 'sm%d' % len(server.sessions)
+                server.sessions[self.sm_id] = 0
+                self.send("<enabled xmlns='%s' id='%s' resume='true'/>" % (SM, self.sm_id))
+            elif tag == '{%s}resume' % SM:
+                time.sleep(server.round_trip)
+                previd = elem.get('previd')
+                if server.resumable and previd in server.sessions:
+                    self.sm_id = previd
+                    server.resumes += 1
+                    self.send("<resumed xmlns='%s' previd=%s h='%d'/>" % (SM, quoteattr(previd),
+                                                                         server.sessions[previd]))
+                else:
+                    self.send("<failed xmlns='%s'><item-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>"
+                              "</failed>" % SM)
+            elif tag == '{%s}r' % SM and server.acking:
+                self.send("<a xmlns='%s' h='%d'/>" % (SM, server.sessions[self.sm_id]))
+            server.changed.notify_all()
+        return False
+
+    def handle_iq(self, elem):
+        iq_id = quoteattr(elem.get('id', ''))
+        if elem.find('{%s}bind' % BIND) is not None:
+            self.server.binds += 1
+            jid = 'connector@%s/stand-in' % self.server.domain
+            self.send("<iq type='result' id=%s><bind xmlns='%s'><jid>%s</jid></bind></iq>" % (iq_id, BIND, jid))
+        else:  # Session, roster and anything else just succeed
+            self.send("<iq type='result' id=%s/>" % iq_id)
@@ -5,9 +5,10 @@
 #    the Free Software Foundation see <http://www.gnu.org/licenses/>.
 #
 
-from threading import Thread
-import multiprocessing
-import queue
+from threading import Thread, Lock, Event
+import itertools
+import math
+import time
 
 
 class TimeoutThread(Thread):
@@ -52,35 +53,6 @@ class TimeoutThreadDisable(Thread):
         return
 
 
-class TimeoutThreadDisableQueue(Thread):
-    def __init__(self, out_queue, seconds, callback_name, callback_arg):
-        super().__init__()
-        self.out_queue = out_queue
-        self.in_queue = multiprocessing.Queue()
-        self.seconds = seconds
-        self.callback_name = callback_name
-        self.callback_arg = callback_arg
-
-    def disable(self):
-        self.in_queue.put("disable")
-
-    def run(self):
-        import time
-        while True:
-            time.sleep(1)
-            self.seconds -= 1
-            if self.seconds == 0:
-                break
-        incoming = ""
-        try:
-            incoming = self.in_queue.get_nowait()
-        except(queue.Empty):
-            pass
-        if(incoming == "disable"):  # Quit before sending item to queue
-            return
-        self.out_queue.put({'name':self.callback_name, 'arg':self.callback_arg})
-        return
-
 # Only used in dispatch.py
 class MultiTimeoutThread(Thread):
     def __init__(self, lock, seconds, callbacks, callback_arg):
@@ -131,56 +103,118 @@ class MultiTimeoutThread(Thread):
                     self.lock.release_lock()
         return
 
-class MultiTimeoutThreadQueue(Thread):
-    def __init__(self, out_queue, seconds, callback_names, callback_arg):
+class TimerHandle(object):
+    """A timer scheduled on a TimerWheel"""
+    __slots__ = ('wheel', 'name', 'arg', 'slot', 'rounds', 'deadline', 'generation')
+
+    def __init__(self, wheel, name, arg):
+        self.wheel = wheel
+        self.name = name
+        self.arg = arg
+        self.slot = None  # None once fired or cancelled
+        self.rounds = 0
+        self.deadline = 0
+        self.generation = None  # New on every (re)schedule, None once cancelled
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def reschedule(self, seconds):
+        self.wheel.reschedule(self, seconds)
+
+    def is_pending(self):
+        return self.slot is not None
+
+
+class TimerWheel(Thread):
+    """Hashed timing wheel driving every timer from one thread.
+
+    Expired timers are put on out_queue as {'name': callback_name, 'arg': callback_arg, 'generation':-}.
+    Schedule, cancel and reschedule are O(1) and never touch the queue, so a timer can be cancelled or
+    rescheduled after its event was queued. is_current() tells the consumer to ignore such an event.
+    """
+    def __init__(self, out_queue, tick=1, slots=512):
         super().__init__()
-        self.in_queue = multiprocessing.Queue()
         self.out_queue = out_queue
-        self.seconds = list(seconds)
-        self.callback_names = list(callback_names)
-        self.callback_arg = callback_arg
-        self.called_callback = [False]*len(callback_names)
-        #for name in callback_names:
-        #    self.called_callback.update({name:{'time': seconds}})
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current_tick = 0
+        self.generations = itertools.count(1)
+        self.fired = {}  # {generation: TimerHandle, ...} Queued events not yet checked with is_current()
+        self.lock = Lock()
+        self.stop_event = Event()
+
+    def schedule(self, seconds, callback_name, callback_arg):
+        handle = TimerHandle(self, callback_name, callback_arg)
+        self.lock.acquire_lock()
+        self._insert(handle, seconds)
+        self.lock.release_lock()
+        return handle
 
-    def disable(self):
-        self.in_queue.put({"disable": True})
+    def cancel(self, handle):
+        self.lock.acquire_lock()
+        self._remove(handle)
+        self.lock.release_lock()
 
-    def set_times_reset(self, *seconds):
-        self.in_queue.put({"times": seconds})
+    def reschedule(self, handle, seconds):
+        self.lock.acquire_lock()
+        self._remove(handle)
+        self._insert(handle, seconds)
+        self.lock.release_lock()
 
-    def exit_check(self):
-        count = 0
-        for value in self.called_callback:
-            if value:
-                count += 1
-        if count == len(self.called_callback):
-            return True
-        return False
+    def _insert(self, handle, seconds):
+        ticks = max(1, int(math.ceil(seconds / self.tick)))
+        handle.slot = (self.current_tick + ticks) % len(self.slots)
+        handle.rounds = (ticks - 1) // len(self.slots)  # Full turns of the wheel before it fires
+        handle.deadline = time.time() + seconds
+        handle.generation = next(self.generations)
+        self.slots[handle.slot].add(handle)
+
+    def _remove(self, handle):
+        if handle.slot is not None:
+            self.slots[handle.slot].discard(handle)
+            handle.slot = None
+        handle.generation = None  # Also voids an event already fired for it
+
+    def is_current(self, generation):
+        """True if the timer that fired this event was not cancelled or rescheduled since, call once per event"""
+        self.lock.acquire_lock()
+        handle = self.fired.pop(generation, None)
+        self.lock.release_lock()
+        return handle is not None and handle.generation == generation
+
+    def advance(self):
+        """Moves the wheel on one tick, returns [(handle, generation it fired at), ...] for the expired timers"""
+        self.lock.acquire_lock()
+        self.current_tick += 1
+        slot = self.slots[self.current_tick % len(self.slots)]
+        expired = []
+        for handle in slot:
+            if handle.rounds == 0:
+                expired.append(handle)
+            else:
+                handle.rounds -= 1
+        for handle in expired:
+            slot.discard(handle)
+            handle.slot = None
+            self.fired[handle.generation] = handle
+        expired = [(handle, handle.generation) for handle in expired]
+        self.lock.release_lock()
+        return expired
+
+    def stop(self):
+        self.stop_event.set()
 
     def run(self):
-        import time
-        while True:
-            time.sleep(1)
-            exit_thread = False
-            incoming = {}
-            try:
-                incoming = self.in_queue.get_nowait()
-            except queue.Empty:
-                pass
-            if "times" in incoming:
-                self.seconds = list(incoming["times"])
-                self.called_callback = [False] * len(incoming["times"])
-            if "disable" in incoming:
-                exit_thread = incoming["disable"]
-
-            if exit_thread or self.exit_check():
-                break
-            for x in range(0, len(self.seconds)):
-                self.seconds[x] -= 1
-                if self.seconds[x] <= 0 and not self.called_callback[x]:
-                    self.out_queue.put({'name':self.callback_names[x], 'arg':self.callback_arg})
-                    self.called_callback[x] = True
+        # Ticks are measured from a fixed start so slow ticks don't accumulate drift.
+        next_tick = time.monotonic()
+        while not self.stop_event.is_set():
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            for handle, generation in self.advance():
+                self.out_queue.put({'name': handle.name, 'arg': handle.arg, 'generation': generation})
         return
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+# When every client is full, new users wait here in arrival order instead of being turned away. Dispatch
+# hands the user at the front to the ring engine whenever a client has room, and tells the others where
+# they are in the queue. A user that waits longer than max_wait is turned away as before.
+
+from collections import OrderedDict
+import bisect
+import time
+
+WAIT_BUCKETS = (5, 15, 30, 60, 120, 300, 600)  # Upper bounds in seconds of the wait time histogram
+
+
+class WaitingRoom(object):
+    """Bounded FIFO of users waiting for a client, only used from the dispatch thread"""
+    def __init__(self, max_size=50, max_wait=300):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        # {str(address): {'service':-, 'text': [text, ...], 'joined': monotonic time, 'timeout_handle':-,
+        #                 'told': position last sent to the user}, ...} Front of the queue first.
+        self.waiting = OrderedDict()
+        self.histogram = [0] * (len(WAIT_BUCKETS) + 1)  # Waits of admitted users, last bucket is longer
+        self.admitted = 0
+        self.turned_away = 0  # Room full or waited too long
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, address):
+        return str(address) in self.waiting
+
+    def join(self, address, service, text, timeout_handle=None, waited=0):
+        """Queues the user at the back, returns False when the room is full"""
+        if len(self.waiting) >= self.max_size:
+            self.turned_away += 1
+            return False
+        self.waiting[str(address)] = {'service': service, 'text': [text], 'joined': time.monotonic() - waited,
+                                      'timeout_handle': timeout_handle, 'told': len(self.waiting) + 1}
+        return True
+
+    def add_text(self, address, text):
+        self.waiting[str(address)]['text'].append(text)
+
+    def position(self, address):
+        """1 for the front of the queue, O(n) so only used when telling users their position"""
+        for position, waiting_address in enumerate(self.waiting, 1):
+            if waiting_address == str(address):
+                return position
+        return None
+
+    def pop_next(self):
+        """(address, entry) at the front of the queue, its wait is recorded in the histogram"""
+        address, entry = self.waiting.popitem(last=False)
+        self.record_wait(time.monotonic() - entry['joined'])
+        self.admitted += 1
+        return address, entry
+
+    def remove(self, address):
+        """Drops a user that waited too long, returns its entry or None"""
+        entry = self.waiting.pop(str(address), None)
+        if entry is not None:
+            self.turned_away += 1
+        return entry
+
+    def moved_up(self):
+        """[(address, service, position), ...] for the users whose position improved since they were told"""
+        moved = []
+        for position, (address, entry) in enumerate(self.waiting.items(), 1):
+            if position < entry['told']:
+                entry['told'] = position
+                moved.append((address, entry['service'], position))
+        return moved
+
+    def record_wait(self, seconds):
+        self.histogram[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        labels = ['<=%ds' % bound for bound in WAIT_BUCKETS] + ['>%ds' % WAIT_BUCKETS[-1]]
+        return {'depth': len(self.waiting), 'max_size': self.max_size, 'admitted': self.admitted,
+                'turned_away': self.turned_away,
+                'longest_wait': now - next(iter(self.waiting.values()))['joined'] if self.waiting else 0,
+                'wait_histogram': OrderedDict(zip(labels, self.histogram))}